@@ -0,0 +1,71 @@
+"""Load benchmark for the web server: latency of device inserts while heavy chart requests run in parallel
+
+Run against a server with a test database, the inserts are real:
+    python benchmark.py http://localhost:5000 --heavy 4 --inserts 50
+"""
+
+import argparse
+import statistics
+import threading
+import time
+import urllib.request
+
+
+def timed_get(url, latencies):
+    start = time.time()
+    try:
+        with urllib.request.urlopen(url, timeout=120) as rsp:
+            rsp.read()
+        latencies.append(time.time() - start)
+    except Exception as err:
+        print('%s failed: %s' % (url, err))
+
+
+def heavy_load(url, stop, latencies):
+    while not stop.is_set():
+        timed_get(url, latencies)
+
+
+def summary(name, latencies):
+    if len(latencies) == 0:
+        return '%-8s no successful requests' % name
+    latencies = sorted(latencies)
+    return '%-8s n=%4d  median %6.0fms  p95 %6.0fms  max %6.0fms' % (
+        name, len(latencies),
+        1000 * statistics.median(latencies),
+        1000 * latencies[int(0.95 * (len(latencies) - 1))],
+        1000 * latencies[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('server', help='base URL, e.g. http://localhost:5000')
+    parser.add_argument('--heavy', type=int, default=4, help='number of parallel clients loading the chart')
+    parser.add_argument('--heavy-path', default='/chart?days=30')
+    parser.add_argument('--inserts', type=int, default=50, help='number of sequential device inserts')
+    parser.add_argument('--insert-path', default='/waterbag?insert_mm=%d')
+    parser.add_argument('--mm', type=int, default=123, help='height inserted by the benchmark')
+    args = parser.parse_args()
+
+    stop = threading.Event()
+    heavy_latencies, insert_latencies = [], []
+    clients = [threading.Thread(target=heavy_load, args=(args.server + args.heavy_path, stop, heavy_latencies))
+               for _ in range(args.heavy)]
+    for client in clients:
+        client.start()
+
+    time.sleep(1)  # let the heavy requests occupy the server first
+    for _ in range(args.inserts):
+        timed_get(args.server + args.insert_path % args.mm, insert_latencies)
+        time.sleep(0.1)
+
+    stop.set()
+    for client in clients:
+        client.join()
+
+    print(summary('insert', insert_latencies))
+    print(summary('chart', heavy_latencies))
+
+
+if __name__ == "__main__":
+    main()
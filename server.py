@@ -3,7 +3,9 @@
 import logging
 import threading
 import os
+import signal
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from http.server import BaseHTTPRequestHandler, HTTPServer
 import urllib
 
@@ -13,12 +15,21 @@ import water.chart
 import water.config
 import water.environment
 import water.dryingfan
+import water.api
+import water.batch
+import water.ingest
+import water.forecastindex
+import water.retention
+import water.cache
+import water.jawsdb
+import water.template
 
 logging.basicConfig(stream=sys.stdout,
                     level=logging.INFO,
                     format='%(funcName)-20s %(message)s')
 
 CFG = None
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', 8))  # requests handled concurrently, the rest wait in the queue
 
 
 class RequestHandler(BaseHTTPRequestHandler):
@@ -26,13 +37,17 @@ class RequestHandler(BaseHTTPRequestHandler):
         global CFG
 
         logging.info('web server gets request: %s' % self.path)
+        parsed_url = urllib.parse.urlparse(self.path)
+        parsed_params = urllib.parse.parse_qs(parsed_url.query)
+
+        if parsed_url.path.startswith('/api'):
+            self.send(*water.api.handle_get(CFG, parsed_url, parsed_params, self.headers.get('If-None-Match')))
+            return
+
         self.send_response(200)
         self.send_header('Content-type', 'text/html')
         self.end_headers()
 
-        parsed_url = urllib.parse.urlparse(self.path)
-        parsed_params = urllib.parse.parse_qs(parsed_url.query)
-
         if parsed_url.path.startswith('/waterbag'):
             water.waterbag.handle_get(CFG, parsed_url, parsed_params, self.wfile)
         elif parsed_url.path.startswith('/forecast'):
@@ -45,24 +60,92 @@ class RequestHandler(BaseHTTPRequestHandler):
             water.environment.handle_get(parsed_url, parsed_params, self.wfile)
         elif parsed_url.path.startswith('/dryingfan'):
             water.dryingfan.handle_get(parsed_url, parsed_params, self.wfile)
+        elif parsed_url.path.startswith('/status'):
+            self.wfile.write(bytes(status(), 'utf-8'))
         else:
             self.wfile.write(bytes("UNKNOWN REQUEST", 'utf-8'))
 
+    def do_POST(self):
+        logging.info('web server gets POST request: %s' % self.path)
+        parsed_url = urllib.parse.urlparse(self.path)
+        parsed_params = urllib.parse.parse_qs(parsed_url.query)
+        length = int(self.headers.get('Content-Length', 0))
+
+        if not parsed_url.path.startswith('/batch'):
+            self.send(404, {'Content-type': 'text/plain'}, b'UNKNOWN REQUEST')
+        elif length > water.batch.MAX_BODY:
+            self.send(413, {'Content-type': 'text/plain', 'Connection': 'close'}, b'BODY TOO LARGE')
+        else:
+            body = self.rfile.read(length).decode('utf-8', errors='replace')
+            self.send(*water.batch.handle_post(CFG, parsed_url, parsed_params, body))
+
+    def send(self, code, headers, body):
+        """send complete response with given status, headers and body"""
+        self.send_response(code)
+        for (name, value) in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def status():
+    """plain text page with server internals"""
+    job = water.retention.JOB
+    return ('<pre>database pool: %s\nchart cache: %s\nforecast refresh: %s\ningest queue: %s\n'
+            '\nseries reads:\n%s\n\nretention: %s\n%s</pre>\n'
+            % (water.jawsdb.POOL.stats(), water.cache.CHART.stats(),
+               water.openweather.REFRESHER.last if water.openweather.REFRESHER is not None else None,
+               water.ingest.QUEUE.stats if water.ingest.QUEUE is not None else None,
+               water.jawsdb.timing_stats(),
+               '%s %s' % (job.last['time'], job.last['result']) if job is not None else None,
+               water.retention.report_lines(job.last['report']) if job is not None else ''))
+
+
+class PoolHTTPServer(HTTPServer):
+    """HTTPServer handing accepted connections to a bounded pool of worker threads,
+       so a slow chart or forecast request does not block sensor inserts"""
+
+    def __init__(self, server_address, handler_class, max_workers):
+        HTTPServer.__init__(self, server_address, handler_class)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='http')
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_worker, request, client_address)
+
+    def process_request_worker(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        self.executor.shutdown(wait=True)  # let requests in progress finish
+
 
 class Web(threading.Thread):
     def __init__(self, cfg):
         threading.Thread.__init__(self)
         self.ip = '127.0.0.1' if 'USER' in os.environ else '0.0.0.0'
         self.port = int(os.environ.get('PORT', 5000))
-        self.do_run = True
         self.cfg = cfg
+        self.httpd = None
 
     def run(self):
-        logging.info('starting web server at %s:%d ...' % (self.ip, self.port))
-        httpd = HTTPServer((self.ip, self.port), RequestHandler)
+        logging.info('starting web server at %s:%d with %d workers ...' % (self.ip, self.port, MAX_WORKERS))
+        self.httpd = PoolHTTPServer((self.ip, self.port), RequestHandler, MAX_WORKERS)
         logging.info('running web server ...')
-        while self.do_run:
-            httpd.handle_request()
+        self.httpd.serve_forever()
+        self.httpd.server_close()
+        logging.info('web server stopped')
+
+    def stop(self):
+        """stop accepting new requests, run() returns after the requests in progress are finished"""
+        if self.httpd is not None:
+            self.httpd.shutdown()
 
 
 def new_daemon(dmn):
@@ -75,9 +158,25 @@ def new_daemon(dmn):
 def run_threads():
     global CFG
     CFG = water.config.CONFIG
+    water.template.preload(water.chart.CHART_TEMPLATE, water.environment.CHART_TEMPLATE, water.dryingfan.CHART_TEMPLATE)
+    with water.jawsdb.JawsDB() as db:
+        water.waterbag.warm_recent(db)
+        water.forecastindex.load(db)
+    water.openweather.start_refresher(CFG)
+    water.ingest.start_queue(CFG)  # after warm_recent, so that replayed readings reach the recent buffers
+    water.retention.start_job()
 
     thr_web = new_daemon(Web(CFG))
-    thr_web.join()
+
+    def stop(signum, frame):
+        logging.info("signal %d received, stopping" % signum)
+        thr_web.stop()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while thr_web.is_alive():
+        thr_web.join(1)  # join with timeout so that the main thread can receive signals
+    water.ingest.stop_queue()  # store readings acknowledged by the last requests
     logging.info("threads joined, shutting down")
 
 
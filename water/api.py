@@ -0,0 +1,153 @@
+"""JSON time series for dashboards: /api/height, /api/volume, /api/forecast, /api/overflow
+
+Parameters from, to (epoch seconds, default last 3 days), step (bucket in seconds, default 0 = raw rows) and device
+(height, volume and overflow series, default device when missing).
+Response is columnar: {"series": ..., "t": [...], "y": [...]}. ETag is derived from the timestamp of the latest
+row of the series and the query, clients sending it back in If-None-Match get 304 until new data arrive."""
+
+import hashlib
+import json
+import logging
+import mysql.connector
+import time
+
+from . import recent
+from .jawsdb import JawsDB, device_param
+from .waterbag import volumes_l, read_overflow_intervals, recent_series
+
+DAY_S = 24*3600
+INTERVAL_PAST_S = 3*DAY_S
+
+
+def handle_get(cfg, url, params, if_none_match):
+    """return (HTTP status, headers, body)"""
+    logging.info('api.handle_get urlparse:%s; parse_qs: %s' % (url, params))
+    series = url.path.rstrip('/').split('/')[-1]
+    if series not in SERIES:
+        return 404, {'Content-type': 'text/plain'}, b'UNKNOWN SERIES'
+
+    tm_to = int(params['to'][0]) if 'to' in params else int(time.time())
+    tm_from = int(params['from'][0]) if 'from' in params else tm_to - INTERVAL_PAST_S
+    step = int(params['step'][0]) if 'step' in params else 0
+    device = device_param(params)
+    latest_sql, read = SERIES[series]
+
+    if series in ('height', 'volume'):
+        buffer = recent.get(recent_series(device))
+        rows = buffer.read(tm_from, tm_to)
+        if rows is not None:  # window is covered by readings in memory, no database access
+            etag = make_etag(cfg, series, int(buffer.latest()), url.query)
+            if if_none_match is not None and etag in [tag.strip() for tag in if_none_match.split(',')]:
+                return 304, {'ETag': etag}, b''
+            t, y = bucket_avg(rows, step)
+            if series == 'volume':
+                y = [round(volume, 1) for volume in volumes_l(cfg, y)]
+            return response(series, tm_from, tm_to, step, t, y, etag)
+
+    db = JawsDB()
+    try:
+        cursor = db.db.cursor()
+        cursor.execute(latest_sql, {'device': device})
+        latest = cursor.fetchone()[0] or 0
+        etag = make_etag(cfg, series, latest, url.query)
+        if if_none_match is not None and etag in [tag.strip() for tag in if_none_match.split(',')]:
+            cursor.close()
+            return 304, {'ETag': etag}, b''
+        t, y = read(cfg, cursor, device, tm_from, tm_to, step)
+        cursor.close()
+    except mysql.connector.Error as err:
+        db.failed(err)
+        return 500, {'Content-type': 'text/plain'}, bytes(err.msg, 'utf-8')
+    finally:
+        db.close()
+
+    return response(series, tm_from, tm_to, step, t, y, etag)
+
+
+def response(series, tm_from, tm_to, step, t, y, etag):
+    body = json.dumps({'series': series, 'from': tm_from, 'to': tm_to, 'step': step, 't': t, 'y': y},
+                      separators=(',', ':'))
+    return 200, {'Content-type': 'application/json', 'ETag': etag, 'Cache-Control': 'no-cache'}, bytes(body, 'utf-8')
+
+
+def make_etag(cfg, series, latest, query):
+    """the query (not the resolved window) identifies the request, so a rolling window is unchanged until a new row
+       arrives; volume also depends on the volume configuration"""
+    key = '%s|%d|%s' % (series, latest, query)
+    if series == 'volume':
+        key += '|%s|%s|%s|%s' % (cfg['volume_method'], cfg['max_volume_l'], cfg['max_height_mm'], cfg['flat_width_mm'])
+    return '"%s"' % hashlib.md5(bytes(key, 'utf-8')).hexdigest()
+
+
+def read_height(cfg, cursor, device, tm_from, tm_to, step):
+    if step > 0:
+        cursor.execute("SELECT time DIV %d * %d, AVG(mm) FROM height"
+                       " WHERE device = %%s AND time BETWEEN %%s and %%s GROUP BY time DIV %d ORDER BY 1"
+                       % (step, step, step), (device, tm_from, tm_to))
+    else:
+        cursor.execute("SELECT time, mm FROM height WHERE device = %s AND time BETWEEN %s and %s ORDER BY time",
+                       (device, tm_from, tm_to))
+    t, y = [], []
+    for (sec, mm) in cursor:
+        t.append(int(sec))
+        y.append(round(float(mm), 1))
+    return t, y
+
+
+def bucket_avg(rows, step):
+    """(t, y) rows sorted by time to columns, averaged per step like read_height does in SQL"""
+    t, y, n = [], [], 0
+    for (sec, value) in rows:
+        bucket = int(sec) // step * step if step > 0 else int(sec)
+        if step > 0 and len(t) > 0 and t[-1] == bucket:
+            n += 1
+            y[-1] += (value - y[-1]) / n
+        else:
+            t.append(bucket)
+            y.append(value)
+            n = 1
+    return t, [round(value, 1) for value in y]
+
+
+def read_volume(cfg, cursor, device, tm_from, tm_to, step):
+    t, mm = read_height(cfg, cursor, device, tm_from, tm_to, step)
+    return t, [round(volume, 1) for volume in volumes_l(cfg, mm)]
+
+
+def read_forecast(cfg, cursor, device, tm_from, tm_to, step):
+    """currently valid rain forecast in mm per slot start (or summed per step), same for all devices"""
+    cursor.execute("SELECT forecast_from, rain_mm FROM forecast"
+                   " WHERE valid_to >= %d"
+                   "   AND forecast_from BETWEEN %d and %d"
+                   " ORDER BY forecast_from"
+                   % (time.time(), tm_from, tm_to))
+    t, y = [], []
+    for (sec, mm) in cursor:
+        bucket = sec // step * step if step > 0 else sec
+        if len(t) > 0 and t[-1] == bucket:
+            y[-1] = round(y[-1] + mm, 2)
+        else:
+            t.append(bucket)
+            y.append(round(mm, 2))
+    return t, y
+
+
+def read_overflow(cfg, cursor, device, tm_from, tm_to, step):
+    """overflow valve state changes, 1 opened, 0 closed (step is ignored, every edge is kept)"""
+    t, y = [], []
+    for (opened, closed) in read_overflow_intervals(cursor, device, tm_from, tm_to):
+        t.append(max(opened, tm_from))
+        y.append(1)
+        if closed is not None:
+            t.append(closed)
+            y.append(0)
+    return t, y
+
+
+SERIES = {  # name: (query for timestamp of the latest row of the device, reader)
+    'height': ("SELECT MAX(time) FROM height WHERE device = %(device)s", read_height),
+    'volume': ("SELECT MAX(time) FROM height WHERE device = %(device)s", read_volume),
+    'forecast': ("SELECT MAX(valid_from) FROM forecast", read_forecast),
+    'overflow': ("SELECT MAX(GREATEST(opened, COALESCE(closed, 0))) FROM overflow WHERE device = %(device)s",
+                 read_overflow),
+}
@@ -0,0 +1,157 @@
+"""POST /batch: many readings and log lines of one device in one request, e.g. those buffered while WiFi was down
+
+Every line of the body is a query string like the one the device sends by GET, e.g. insert_mm=300&time=1600000000
+or insert_temperature=21.5&insert_humidity=55&offset_ms=-60000. The time is given in epoch seconds (time) or
+relative to the arrival of the request (offset_ms), default is now. The device is the parameter of the URL, e.g.
+POST /batch?device=tank2. All lines are inserted in one transaction. The response has one status line per body line:
+OK, DUPLICATE (stored already, e.g. a batch resent after its response was lost) or ERROR with the reason."""
+
+import logging
+import mysql.connector
+import time
+import urllib
+
+from . import cache, recent
+from . import dryingfan
+from .jawsdb import JawsDB, device_param, reading_time
+from .waterbag import apply_overflow_msg, update_rollups, recent_series, OVERFLOW_OPENED, OVERFLOW_CLOSED
+
+MAX_BODY = 1024*1024  # bytes
+MAX_LINES = 5000
+FUTURE_TOLERANCE_S = 60  # device clock may be slightly ahead
+MANY_PER_SECOND = ('log',)  # other tables are keyed by (device, time), their duplicates are recognized by time
+MERGED = ('environment',)  # values of the same second are merged into one row, so resending is harmless
+DERIVED = {'dryingfan': (dryingfan.DERIVED, dryingfan.derived)}  # table: (columns, function of the values)
+
+TABLES = [  # (table, time column, [(parameter, column, type)]), a line fills a row of each table it has parameters of
+    ('height', 'time', [('insert_mm', 'mm', int)]),
+    ('log', 'time', [('insert_log', 'msg', str)]),
+    ('environment', 'time_ms', [('insert_temperature', 'temperature_c', float),
+                                ('insert_humidity', 'humidity_pct', int),
+                                ('insert_moisture', 'moisture_res', int)]),
+    ('dryingfan', 'time_ms', [('insert_temperature_out', 'temperature_out', float),
+                              ('insert_humidity_out', 'humidity_out', int),
+                              ('insert_temperature_in', 'temperature_in', float),
+                              ('insert_humidity_in', 'humidity_in', int)]),
+]
+
+
+def handle_post(cfg, url, params, body):
+    """return (HTTP status, headers, body)"""
+    device = device_param(params)
+    lines = body.splitlines()
+    logging.info('batch.handle_post of %s: %d lines' % (device, len(lines)))
+    if len(lines) > MAX_LINES:
+        return 413, {'Content-type': 'text/plain'}, bytes('TOO MANY LINES, MAX %d' % MAX_LINES, 'utf-8')
+
+    tm_now = int(time.time())
+    status = [None] * len(lines)
+    rows = dict((table, []) for (table, _, _) in TABLES)  # table: [(line index, time, values)]
+    for (i, line) in enumerate(lines):
+        try:
+            if parse_line(line, tm_now, i, rows) == 0:
+                status[i] = 'ERROR nothing to insert'
+        except ValueError as err:
+            status[i] = 'ERROR %s' % err
+
+    db = JawsDB()
+    try:
+        if db.db is None:
+            raise mysql.connector.Error(msg='no database connection')
+        inserted, duplicate = store(db, device, rows)
+    except mysql.connector.Error as err:
+        db.rollback(err)
+        logging.error('batch of %s failed: %s' % (device, err.msg))
+        return 503, {'Content-type': 'text/plain'}, bytes('\n'.join(
+            status[i] or 'ERROR %s' % err.msg for i in range(len(lines))), 'utf-8')
+    finally:
+        db.close()
+
+    for i in range(len(lines)):
+        if status[i] is None:
+            status[i] = 'OK' if inserted[i] > 0 else 'DUPLICATE' if duplicate[i] > 0 else 'ERROR'
+    return 200, {'Content-type': 'text/plain'}, bytes('\n'.join(status), 'utf-8')
+
+
+def parse_line(line, tm_now, i, rows):
+    """append rows of the line to rows, return their number; ValueError if some value is not valid"""
+    item = urllib.parse.parse_qs(line.strip())
+    tm = int(reading_time(item, tm_now))
+    if tm > tm_now + FUTURE_TOLERANCE_S:
+        raise ValueError('time in future')
+
+    line_rows = []
+    for (table, _, columns) in TABLES:
+        if any(param in item for (param, _, _) in columns):
+            values = []
+            for (param, _, convert) in columns:
+                try:
+                    values.append(convert(item[param][0]) if param in item else None)
+                except ValueError:
+                    raise ValueError('bad value of %s' % param)
+            line_rows.append((table, (i, tm, tuple(values))))
+    for (table, row) in line_rows:  # all or nothing of one line
+        rows[table].append(row)
+    return len(line_rows)
+
+
+def store(db, device, rows):
+    """insert rows not stored yet in one transaction, return number of inserted and duplicate rows per line"""
+    inserted, duplicate = dict(), dict()
+    for table_rows in rows.values():
+        for (i, _, _) in table_rows:
+            inserted[i], duplicate[i] = 0, 0
+
+    cursor = db.db.cursor()
+    new_rows = dict()
+    for (table, time_column, columns) in TABLES:
+        new_rows[table] = []
+        if len(rows[table]) == 0:
+            continue
+        seen = stored_keys(cursor, device, table, time_column, rows[table]) if table not in MERGED else set()
+        for (i, tm, values) in rows[table]:
+            key = (tm,) + values if table in MANY_PER_SECOND else (tm,)
+            if table not in MERGED and key in seen:
+                duplicate[i] += 1
+            else:
+                seen.add(key)
+                new_rows[table].append((i, tm, values))
+                inserted[i] += 1
+        if len(new_rows[table]) > 0:
+            names = [column for (_, column, _) in columns]
+            args = [(device, tm) + values for (_, tm, values) in new_rows[table]]
+            if table in DERIVED:
+                derived_names, derive = DERIVED[table]
+                names += derived_names
+                args = [row + derive(*row[2:]) for row in args]
+            if not db.insert(table, ', '.join(['device', time_column] + names), ', '.join(['%s'] * (len(names) + 2)),
+                             args, commit=False, merge_names=names if table in MERGED else None):
+                raise mysql.connector.Error(msg='insert into %s failed' % table)
+
+    overflow = sorted((tm, values[0]) for (_, tm, values) in new_rows['log']
+                      if values[0].startswith(OVERFLOW_OPENED) or values[0].startswith(OVERFLOW_CLOSED))
+    for (tm, msg) in overflow:
+        apply_overflow_msg(cursor, device, tm, msg)
+    cursor.close()
+
+    heights = sorted((tm, values[0]) for (_, tm, values) in new_rows['height'])
+    if len(heights) > 0:
+        if not update_rollups(db, device, heights):  # commits
+            raise mysql.connector.Error(msg='update of rollups failed')
+        buffer = recent.get(recent_series(device))
+        for (tm, mm) in heights:
+            buffer.append(tm, mm)
+    else:
+        db.db.commit()
+    if len(heights) > 0 or len(overflow) > 0:
+        cache.invalidate()
+    return inserted, duplicate
+
+
+def stored_keys(cursor, device, table, time_column, table_rows):
+    """keys of rows of the device already stored within the time range of table_rows"""
+    times = [tm for (_, tm, _) in table_rows]
+    cursor.execute("SELECT %s FROM %s WHERE device = %%s AND %s BETWEEN %%s AND %%s"
+                   % (time_column + (', msg' if table in MANY_PER_SECOND else ''), table, time_column),
+                   (device, min(times), max(times)))
+    return set(tuple(row) for row in cursor)
@@ -0,0 +1,56 @@
+"""rendered pages cached until the data they are built from change"""
+
+import os
+import threading
+import time
+
+TTL_S = int(os.environ.get('CACHE_TTL_S', 300))  # bounds staleness of time dependent parts like the moving window
+MAX_ENTRIES = 32
+
+
+class Cache:
+    """entries are dropped by invalidate() whenever the underlying data change, values computed
+       from data read before the invalidation are not stored (see generation)"""
+
+    def __init__(self, ttl_s, max_entries):
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self.entries = dict()  # key: (expires, value)
+        self.generation = 0
+        self.hits, self.misses = 0, 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """return (value or None, generation to pass to put)"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                self.hits += 1
+                return entry[1], self.generation
+            self.misses += 1
+            return None, self.generation
+
+    def put(self, key, value, generation):
+        with self.lock:
+            if generation != self.generation:
+                return  # data changed while the value was computed
+            if len(self.entries) >= self.max_entries:
+                self.entries.clear()
+            self.entries[key] = (time.time() + self.ttl_s, value)
+
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return dict(entries=len(self.entries), hits=self.hits, misses=self.misses, generation=self.generation)
+
+
+CHART = Cache(TTL_S, MAX_ENTRIES)
+
+
+def invalidate():
+    """call when heights, overflow log, forecast or server config change"""
+    CHART.invalidate()
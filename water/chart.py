@@ -2,73 +2,94 @@ import logging
 import mysql.connector
 import time
 
-from .jawsdb import JawsDB, timeseries_csv
-from .waterbag import volume_l, rain_l
+from . import cache, forecastindex, recent, template
+from .downsample import lttb
+from .jawsdb import JawsDB, timeseries_csv, device_param, fetch_parallel
+from .waterbag import volume_l, volumes_l, rain_l, read_overflow_intervals, total_overflow_s, recent_series, ROLLUPS
 
 CHART_TEMPLATE = 'chart.html'
 DAY_S = 24*3600
 INTERVAL_PAST_S = 3*DAY_S
 INTERVAL_FUTURE_S = 3*DAY_S
+RAW_MAX_S = 7*DAY_S  # longer charts read hourly rollups
+HOURLY_MAX_S = 90*DAY_S  # longer charts read daily rollups
+POINTS_DEFAULT = 1000  # stored volume is downsampled to this many points unless the page asks for other budget
 
 
 def handle_get(cfg, url, params, wfile):
-    db = JawsDB()
-
     logging.info('chart.handle_get urlparse:%s; parse_qs: %s' % (url, params))
-    global INTERVAL_PAST_S, INTERVAL_FUTURE_S
+    interval_past_s, interval_future_s = INTERVAL_PAST_S, INTERVAL_FUTURE_S
     if 'days' in params and int(params['days'][0]) > 0:
-        INTERVAL_PAST_S = int(params['days'][0]) * DAY_S
-        INTERVAL_FUTURE_S = INTERVAL_PAST_S
+        interval_past_s = int(params['days'][0]) * DAY_S
+        interval_future_s = interval_past_s
     if 'hours' in params and int(params['hours'][0]) > 0:
-        INTERVAL_PAST_S = int(params['hours'][0]) * 3600
-        INTERVAL_FUTURE_S = INTERVAL_PAST_S
-
-    rsp = html_chart(cfg, db)
-
-    if rsp == "":
-        rsp = "UNKNOWN REQUEST"
-
-    wfile.write(bytes(rsp, 'utf-8'))
-
-
-def html_chart(cfg, db):
+        interval_past_s = int(params['hours'][0]) * 3600
+        interval_future_s = interval_past_s
+    points = int(params['points'][0]) if 'points' in params else POINTS_DEFAULT  # 0 disables downsampling
+    device = device_param(params)
+
+    key = (device, interval_past_s, interval_future_s, points)
+    page, generation = cache.CHART.get(key)
+    if page is None:
+        db = JawsDB()
+        values = chart_values(cfg, db, device, interval_past_s, interval_future_s, points)
+        db.close()
+        page = list(template.get(CHART_TEMPLATE).chunks(values))
+        cache.CHART.put(key, page, generation)
+    for chunk in page:
+        wfile.write(chunk)
+
+
+def chart_values(cfg, db, device, interval_past_s, interval_future_s, points=POINTS_DEFAULT):
+    """values of CHART_TEMPLATE placeholders"""
     tm_now = time.time()
     (stored, forecasted_rain, overflow, now_l, overflow_s, total_open_s) = \
-        get_data(cfg, db, tm_now - INTERVAL_PAST_S, tm_now, tm_now + INTERVAL_FUTURE_S)
-    with open(CHART_TEMPLATE, 'r') as template_file:
-        return template_file.read()\
-            .replace('%STATE%', '%dl %s' % (now_l, ('OPENED %ds' % overflow_s) if overflow_s>=0 else ''))\
-            .replace('%STORED%', stored) \
-            .replace('%OVERFLOW%', overflow) \
-            .replace('%FORECASTED_RAIN%', forecasted_rain)\
-            .replace('%MAX_L%', '%d' % round(1.25 * float(cfg['max_volume_l'])))\
-            .replace('%TOTAL_OVERFLOW_S%', '%d' % total_open_s)\
-            .replace('%TOTAL_OVERFLOW_L%', '%d' % (total_open_s * float(cfg['overflow_l_per_s'])))
-
-
-def get_data(cfg, db, tm_from, tm_now, tm_to):
-    """returns:
-       - time series [{t,stored}] printed as string
+        get_data(cfg, db, device, tm_now - interval_past_s, tm_now, tm_now + interval_future_s, points)
+    return dict(
+        DEVICE=device,
+        STATE='%dl %s' % (now_l, ('OPENED %ds' % overflow_s) if overflow_s>=0 else ''),
+        STORED=stored,
+        OVERFLOW=overflow,
+        FORECASTED_RAIN=forecasted_rain,
+        MAX_L='%d' % round(1.25 * float(cfg['max_volume_l'])),
+        TOTAL_OVERFLOW_S='%d' % total_open_s,
+        TOTAL_OVERFLOW_L='%d' % (total_open_s * float(cfg['overflow_l_per_s'])))
+
+
+def get_data(cfg, db, device, tm_from, tm_now, tm_to, points=None):
+    """returns for the device:
+       - time series [{t,stored}] printed as string, downsampled to given number of points
        - time series [{t,forecast}] printed as string
        - time series [{t,0 or CONST * max_volume based on overflow closed/opened}] printed as a string
        - current volume
        - how many seconds is overflow opened (or -1 if closed)
-       - how long was the overflow opened in seconds over the time between tm_from and tm_now"""
+       - how long was the overflow opened in seconds over the time between tm_from and tm_now
+       stored volume (unless it is in memory) and overflow are read concurrently, forecast is in memory"""
     try:
-        cursor = db.db.cursor()
-
-        stored = read_stored(cfg, cursor, tm_from, tm_to)
+        readers = dict()
+        rollup = rollup_for_span(tm_now - tm_from)
+        stored = read_recent(cfg, device, tm_from, tm_to) if rollup is None else None
+        if stored is None and rollup is None:
+            readers['chart stored'] = lambda cursor: read_stored(cfg, cursor, device, tm_from, tm_to)
+        elif stored is None:
+            readers['chart rollup'] = lambda cursor: read_rollup(cfg, cursor, device, rollup, tm_from, tm_to)
+        readers['chart overflow'] = lambda cursor: read_overflow(cfg, cursor, device, tm_from, tm_to)
+        results = fetch_parallel(db, readers)
+        if stored is None:
+            stored = results['chart stored' if rollup is None else 'chart rollup']
 
         if stored is None or len(stored) < 1:
-            stored, forecast, overflow = [{tm_now-INTERVAL_PAST_S,0}, {tm_now,0}], [], []
+            stored, forecast, overflow = [(tm_from, 0), (tm_now, 0)], [], []
             last_stored_l, total_open_s = 0, 0
         else:
             last_stored_ts, last_stored_l = stored[-1]
-            forecast = read_forecast(cfg, cursor, last_stored_ts, last_stored_l, tm_now, tm_to)
-            overflow, total_open_s = read_overflow(cfg, cursor, last_stored_ts, tm_from, tm_to)
+            forecast = read_forecast(cfg, db, last_stored_ts, last_stored_l, tm_to)
+            overflow, total_open_s = results['chart overflow']
+            if len(overflow) > 0:
+                overflow.append((last_stored_ts, overflow[-1][1]))  # current state until the last stored volume
 
-        cursor.close()
-        return (timeseries_csv(stored), timeseries_csv(forecast), timeseries_csv(overflow),
+        # overflow is step series with few points, it is not downsampled so that the edges stay exact
+        return (timeseries_csv(lttb(stored, points)), timeseries_csv(forecast), timeseries_csv(overflow),
                 last_stored_l,
                 tm_now - overflow[-1][0] if len(overflow) > 0 and overflow[-1][1]>0 else -1,
                 total_open_s)
@@ -76,51 +97,59 @@ def get_data(cfg, db, tm_from, tm_now, tm_to):
         return err.msg
 
 
-def read_stored(cfg, cursor, tm_from, tm_to):
-    stored = []
+def read_stored(cfg, cursor, device, tm_from, tm_to):
     cursor.execute("SELECT time, mm FROM height"
-                   " WHERE time BETWEEN %d and %d ORDER BY time"
-                   % (tm_from, tm_to))
-    for (sec, mm) in cursor:
-        stored.append((sec, volume_l(cfg, mm)))
+                   " WHERE device = %s AND time BETWEEN %s and %s ORDER BY time",
+                   (device, int(tm_from), int(tm_to)))
+    rows = cursor.fetchall()
+    return list(zip([sec for (sec, mm) in rows], volumes_l(cfg, [mm for (sec, mm) in rows])))
+
+
+def read_recent(cfg, device, tm_from, tm_to):
+    """stored volume from memory, None if the window is not covered there"""
+    rows = recent.get(recent_series(device)).read(tm_from, tm_to)
+    if rows is None:
+        return None
+    return list(zip([int(sec) for (sec, mm) in rows], volumes_l(cfg, [mm for (sec, mm) in rows])))
+
+
+def rollup_for_span(span_s):
+    """(table, bucket_s) of rollup to use for chart of given span, None for raw heights"""
+    if span_s <= RAW_MAX_S:
+        return None
+    return ROLLUPS[0] if span_s <= HOURLY_MAX_S else ROLLUPS[1]
+
+
+def read_rollup(cfg, cursor, device, rollup, tm_from, tm_to):
+    """average volume per bucket plotted in the bucket middle, ending with the last stored volume"""
+    table, bucket_s = rollup
+    stored = []
+    last = None
+    cursor.execute("SELECT time, mm_sum / n, mm_last, last_time FROM %s"
+                   " WHERE device = %%s AND time BETWEEN %%s and %%s ORDER BY time" % table,
+                   (device, int(tm_from) // bucket_s * bucket_s, int(tm_to)))
+    for (bucket_ts, mm_avg, mm_last, last_ts) in cursor:
+        stored.append((min(bucket_ts + bucket_s // 2, last_ts), volume_l(cfg, float(mm_avg))))
+        last = (last_ts, mm_last)
+    if last is not None and last[0] > stored[-1][0]:
+        stored.append((last[0], volume_l(cfg, last[1])))
     return stored
 
 
-def read_forecast(cfg, cursor, last_stored_ts, last_stored_l, tm_now, tm_to):
-    cursor.execute("SELECT forecast_from, forecast_to, rain_mm FROM forecast"
-                   " WHERE valid_to >= %d"
-                   "   AND (forecast_from BETWEEN %d and %d"
-                   "        OR forecast_to BETWEEN %d and %d)"
-                   " ORDER BY forecast_from"
-                   % (tm_now, tm_now, tm_to, tm_now, tm_to))
-    forecast = [(last_stored_ts, last_stored_l)]
-    cumsum_l = last_stored_l
-    for (from_s, to_s, mm) in cursor:
-        cumsum_l += rain_l(cfg, mm)
-        forecast.append((int((from_s + to_s) / 2), cumsum_l))
-    if len(forecast) >= 2 and forecast[1][0] < last_stored_ts:
-        forecast[1] = (last_stored_ts, forecast[1][1])  # do not go back in time with first forecast
-        # TODO forecast only proportionate part of rain?
-    return forecast
-
-
-def read_overflow(cfg, cursor, last_stored_ts, tm_from, tm_to):
-    total_open_s = 0
+def read_forecast(cfg, db, last_stored_ts, last_stored_l, tm_to):
+    """stored volume plus the rain forecasted since the last stored volume, from the in-memory forecast index"""
+    return [(sec, last_stored_l + rain_l(cfg, mm))
+            for (sec, mm) in forecastindex.get(db).curve(int(last_stored_ts), int(tm_to))]
+
+
+def read_overflow(cfg, cursor, device, tm_from, tm_to):
+    level = float(cfg['max_volume_l']) / 6
     overflow = []
-    cursor.execute("SELECT time, msg FROM log"
-                   " WHERE time BETWEEN %d and %d"
-                   "   AND msg LIKE 'overflow_%%'"
-                   " ORDER BY time"
-                   % (tm_from, tm_to))
-    for (log_ts, msg) in cursor:
-        if msg.startswith('overflow_opened'):  # going up
-            overflow.append((log_ts, 0))
-            overflow.append((log_ts, float(cfg['max_volume_l'] / 6)))
-        if msg.startswith('overflow_closed'):  # going down
-            if len(overflow) > 0:
-                total_open_s += log_ts - overflow[-1][0]
-            overflow.append((log_ts, float(cfg['max_volume_l'] / 6)))
-            overflow.append((log_ts, 0))
-    if len(overflow) > 0:
-        overflow.append((last_stored_ts, overflow[-1][1]))
-    return overflow, total_open_s
+    for (opened, closed) in read_overflow_intervals(cursor, device, tm_from, tm_to):
+        opened = max(opened, tm_from)
+        overflow.append((opened, 0))  # going up
+        overflow.append((opened, level))
+        if closed is not None:  # going down
+            overflow.append((closed, level))
+            overflow.append((closed, 0))
+    return overflow, total_overflow_s(cursor, device, tm_from, tm_to)
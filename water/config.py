@@ -2,8 +2,9 @@ import json
 import logging
 import mysql.connector
 
-from .jawsdb import JawsDB
-from .waterbag import insert_command
+from . import cache
+from .jawsdb import JawsDB, device_param
+from .waterbag import insert_command, volume_model
 
 CONFIG = dict(
     max_height_mm = 600,    # maximum allowed waterbag height (or water level in water tank)
@@ -24,24 +25,27 @@ def handle_get(cfg, url, params, wfile):
     rsp = ""
 
     logging.info('chart.handle_get urlparse:%s; parse_qs: %s' % (url, params))
+    device = device_param(params)
+    params = {key: value for (key, value) in params.items() if key != 'device'}
 
     if any(value is not None for value in params.values()):
-        rsp = update_config(cfg, db, params)
+        rsp = update_config(cfg, db, device, params)
     else:
-        rsp = html_table_config(cfg, db)
+        rsp = html_table_config(cfg, db, device)
 
     if rsp == "":
         rsp = "UNKNOWN REQUEST"
 
+    db.close()
     wfile.write(bytes(rsp, 'utf-8'))
 
 
-def update_config(cfg, db, params):
-    """update existing parameters with new values, insert new ones (assume they are sensor config, not server)
-       TODO delete feature"""
-    rsp = '<h1>Changed Parameters</h1>'
+def update_config(cfg, db, device, params):
+    """update existing parameters with new values, insert new ones (assume they are sensor config of the device,
+       not server) TODO delete feature"""
+    rsp = '<h1>Changed Parameters of %s</h1>' % device
     global CONFIG
-    sensor_config_current, _ = get_data(db)
+    sensor_config_current, _ = get_data(db, device)
     sensor_config_new = sensor_config_current.copy()
     sensor_changed, server_changed = False, False
 
@@ -60,22 +64,25 @@ def update_config(cfg, db, params):
     if sensor_changed:
         cmd = json.dumps(sensor_config_new, separators=(',', ':'))
         rsp += '<p>Inserting sensor config:</p><pre>%s</pre><p>The config will be read next time the sensor connects.</p>' % cmd
-        if insert_command(db, cmd):
+        if insert_command(db, cmd, device):
             rsp += '<p>Insert OK</p>'
         else:
             rsp += '<p>Insert FAILED</p>'
     if server_changed:
+        volume_model(CONFIG)  # rebuild lookup table now rather than in the next chart request
+        cache.invalidate()  # volumes in the chart depend on server config
         rsp += '<p><b>Server parameter(s) changed but they are not persisted in database.</b></p>\n'
 
-    return HTML_START + rsp + '<p><a href="config">back to config</a></p>' + HTML_END
+    return HTML_START + rsp + '<p><a href="config?device=%s">back to config</a></p>' % device + HTML_END
 
 
-def html_table_config(cfg, db):
+def html_table_config(cfg, db, device):
     """return table of parameters as a string, including form to enter new parameters"""
-    sensor_config_current, sensor_config_new = get_data(db)
+    sensor_config_current, sensor_config_new = get_data(db, device)
 
     html =  HTML_START + \
            '<form action="config">' \
+           '<input type="hidden" name="device" value="%s">' % device + \
            '<table cellpadding=2 border=1>' \
            '<tr><th>Parameter</th><th>Current value</th><th>Waiting value</th><th>Enter new value</th></tr>'
 
@@ -92,33 +99,35 @@ def html_table_config(cfg, db):
                   HTML_END
 
 
-def get_data(db):
+def get_data(db, device):
     """returns:
        - current configuration of the sensor
        - new configuration not yet read by the sensor"""
     try:
         cursor = db.db.cursor()
-        sensor_config_current, sensor_config_new = read_sensor_config(cursor)
+        sensor_config_current, sensor_config_new = read_sensor_config(cursor, device)
         cursor.close()
         return (sensor_config_current, sensor_config_new)
     except mysql.connector.Error as err:
+        db.failed(err)
         return err.msg
 
 
-def read_sensor_config(cursor):
+def read_sensor_config(cursor, device):
+    """config delivered to the device last, and config waiting for it (or for any device)"""
     cfg_current, cfg_new = dict(), dict()
 
     cursor.execute("SELECT time, cmd FROM command "
-                   " WHERE popped='Y'"
+                   " WHERE popped='Y' AND device = %s"
                    "   AND cmd LIKE '{%%}'"
-                   " ORDER BY time desc LIMIT 1")
+                   " ORDER BY time desc LIMIT 1", (device,))
     for (cmd_ts, cmd) in cursor:
         cfg_current = json.loads(cmd)
 
     cursor.execute("SELECT time, cmd FROM command "
-                   " WHERE popped='N'"
+                   " WHERE popped='N' AND (device IS NULL OR device = %s)"
                    "   AND cmd LIKE '{%%}'"
-                   " ORDER BY time desc LIMIT 1")
+                   " ORDER BY time desc LIMIT 1", (device,))
     for (cmd_ts, cmd) in cursor:
         cfg_new = json.loads(cmd)
 
@@ -0,0 +1,41 @@
+"""reduce time series to a point budget while preserving its visual shape"""
+
+
+def lttb(points, budget):
+    """largest-triangle-three-buckets downsampling of [(t, y)] sorted by t
+
+    The first and last point are always kept, the rest is split into budget-2 buckets and from each bucket
+    the point forming the largest triangle with the point selected in the previous bucket and the average
+    of the next bucket is kept. Peaks and steps therefore survive, unlike with plain averaging.
+    Budget < 3 or series shorter than budget are returned unchanged."""
+    n = len(points)
+    if budget is None or budget < 3 or n <= budget:
+        return points
+
+    sampled = [points[0]]
+    bucket_size = (n - 2) / (budget - 2)
+    a = 0  # index of the point selected in previous bucket
+
+    for i in range(budget - 2):
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+
+        # average of the next bucket (the last point for the last bucket)
+        next_start, next_end = end, min(int((i + 2) * bucket_size) + 1, n)
+        if next_start >= next_end:
+            next_start, next_end = n - 1, n
+        avg_t = sum(p[0] for p in points[next_start:next_end]) / (next_end - next_start)
+        avg_y = sum(p[1] for p in points[next_start:next_end]) / (next_end - next_start)
+
+        a_t, a_y = points[a]
+        max_area, selected = -1, start
+        for j in range(start, end):
+            t, y = points[j]
+            area = abs((a_t - avg_t) * (y - a_y) - (a_t - t) * (avg_y - a_y))  # doubled triangle area
+            if area > max_area:
+                max_area, selected = area, j
+        sampled.append(points[selected])
+        a = selected
+
+    sampled.append(points[-1])
+    return sampled
@@ -3,16 +3,21 @@ import math
 import mysql.connector
 import time
 
-CHART_TEMPLATE = 'chart_environment.html'
+CHART_TEMPLATE = 'chart_dryingfan.html'
 INTERVAL_PAST_S = 3*24*3600
+CHART_BUCKETS = 300  # aim for about this many points, the bucket is the smallest of BUCKETS_S giving at most that many
+BUCKETS_S = (60, 300, 900, 1800, 3600, 3*3600, 6*3600, 12*3600, 24*3600)
+FAN_MARGIN_G_M3 = 0.5  # fan runs if the air outside is drier by at least this absolute humidity
+BACKFILL_BATCH = 1000  # rows per UPDATE transaction of backfill_derived
 
 
 def handle_get(url, params, wfile):
-    db = JawsDB()
-    offset_ms, temperature_out, humidity_out, temperature_in, humidity_in = 0, None, None, None, None
+    db = None
+    temperature_out, humidity_out, temperature_in, humidity_in = None, None, None, None
     rsp = ""
 
     logging.info('waterbag.handle_get urlparse:%s; parse_qs: %s' % (url, params))
+    device = device_param(params)
     interval_s = INTERVAL_PAST_S
     if 'days' in params and int(params['days'][0]) > 0:
         interval_s = int(params['days'][0]) * 24 * 3600
@@ -27,46 +32,80 @@ def handle_get(url, params, wfile):
         temperature_in = float(params['insert_temperature_in'][0])
     if 'insert_humidity_in' in params:
         humidity_in = int(params['insert_humidity_in'][0])
-    if 'offset_ms' in params:
-        offset_ms = int(params['offset_ms'][0])
 
     if temperature_out is not None or humidity_out is not None or temperature_in is not None or humidity_in is not None:
-        insert_environment(db, offset_ms, temperature_out, humidity_out, temperature_in, humidity_in)
+        if ingest.QUEUE is not None:
+            ingest.QUEUE.submit(device, reading_time(params, time.time()), params)
+        else:
+            db = JawsDB()
+            insert_environment(db, device, reading_time(params, time.time()),
+                               temperature_out, humidity_out, temperature_in, humidity_in)
         rsp += 'OK'
     elif url.path.endswith('table'):
-        rsp += "<pre>" + table_environment(db) + "</pre>\n"
-    #elif url.path.endswith('chart') or url.path == '/dryingfan':
-    #    rsp += chart_environment(db, interval_s)
+        before, limit = page_params(params)
+        db = JawsDB()
+        next_href = 'table?device=' + device + '&before=%d&limit=%d'
+        stream_pre(wfile, table_environment(db, device, before, limit, next_href))
+        db.close()
+        return
+    elif url.path.endswith('chart') or url.path.rstrip('/') == '/dryingfan':
+        db = JawsDB()
+        values = chart_values(db, device, interval_s)
+        db.close()
+        template.get(CHART_TEMPLATE).render(wfile, values)
+        return
     else:
         rsp = "UNKNOWN REQUEST"
 
+    if db is not None:
+        db.close()
     wfile.write(bytes(rsp, 'utf-8'))
 
 
-def insert_environment(db, offset_ms, temperature_out, humidity_out, temperature_in, humidity_in):
-    time_ms = time.time() + offset_ms
+def insert_environment(db, device, tm, temperature_out, humidity_out, temperature_in, humidity_in):
+    """store reading taken at tm with absolute humidity and fan decision derived from it"""
 
     db.insert('dryingfan',
-              'time_ms, temperature_out, humidity_out, temperature_in, humidity_in',
-              '%s, %s, %s, %s, %s',
-              (time_ms, temperature_out, humidity_out, temperature_in, humidity_in))
+              'device, time_ms, temperature_out, humidity_out, temperature_in, humidity_in, ' + ', '.join(DERIVED),
+              '%s, %s, %s, %s, %s, %s, %s, %s, %s',
+              (device, int(tm), temperature_out, humidity_out, temperature_in, humidity_in)
+              + derived(temperature_out, humidity_out, temperature_in, humidity_in))
+
+
+DERIVED = ('abs_out', 'abs_in', 'fan')  # columns computed by derived()
+
+
+def derived(temperature_out, humidity_out, temperature_in, humidity_in):
+    """absolute humidity outside and inside, fan on (Y) when outside air is drier, None if some value is missing"""
+    abs_out = abs_humidity(temperature_out, humidity_out)
+    abs_in = abs_humidity(temperature_in, humidity_in)
+    return abs_out, abs_in, fan_flag(abs_out, abs_in)
+
+
+def fan_flag(abs_out, abs_in):
+    if abs_out is None or abs_in is None:
+        return None
+    return 'Y' if (abs_out + FAN_MARGIN_G_M3) <= abs_in else 'N'
 
 
-def table_environment(db):
-    """return list of temperature and humidity measurements in pre-tags"""
-    rsp =  "time                     outside      inside     [g/m3]"
-    rsp =  "time                   temp   hum   temp   hum  out  in"
+def table_environment(db, device, before=None, limit=None, next_href=None):
+    """generate lines of temperature and humidity measurements older than before, newest first,
+       ends with link to next page if next_href is given"""
+    limit = limit if limit is not None else PAGE_LIMIT
+    yield "time                   temp   hum   temp   hum  out  in"
+    cursor = None
     try:
         cursor = db.db.cursor()
-        query = ("SELECT time_ms, temperature_out, humidity_out, temperature_in, humidity_in"
-                 "  FROM dryingfan"
-                 " ORDER BY time_ms desc")
-        cursor.execute(query)
-
-        for (time_ms, temperature_out, humidity_out, temperature_in, humidity_in) in cursor:
-            abs_out = abs_humidity(temperature_out, humidity_out)
-            abs_in  = abs_humidity(temperature_in, humidity_in)
-            rsp += "\n%s  %s  %s  %s %s %s %s %s" % (
+        cursor.execute("SELECT time_ms, temperature_out, humidity_out, temperature_in, humidity_in,"
+                       "       abs_out, abs_in, fan"
+                       "  FROM dryingfan"
+                       " WHERE device = %s AND time_ms < %s"
+                       " ORDER BY time_ms desc LIMIT %s",
+                       (device, before if before is not None else 2**32, limit))
+
+        n_rows, last_ts = 0, None
+        for (time_ms, temperature_out, humidity_out, temperature_in, humidity_in, abs_out, abs_in, fan) in cursor:
+            yield "\n%s  %s  %s  %s %s %s %s %s" % (
                         time.strftime("%a %d.%m. %X", time.localtime(time_ms)),
                         '%5.1fC' % temperature_out if temperature_out is not None else '  n/a ',
                         '%3d%%' % humidity_out if humidity_out is not None else 'n/a ',
@@ -74,13 +113,66 @@ def table_environment(db):
                         '%3d%%' % humidity_in if humidity_in is not None else 'n/a ',
                         '%3d' % abs_out if abs_out is not None else 'n/a',
                         '%3d' % abs_in if abs_in is not None else 'n/a',
-                        'FAN' if abs_out is not None and abs_in is not None and (abs_out+0.5) <= abs_in else ''
+                        'FAN' if fan == 'Y' else ''
             )
+            n_rows, last_ts = n_rows + 1, time_ms
+        yield next_page_link(next_href, last_ts, n_rows, limit)
+    except mysql.connector.Error as err:
+        db.failed(err)
+        yield err.msg
+    finally:
+        if cursor is not None:
+            cursor.close()
 
-        cursor.close()
+
+def chart_values(db, device, interval_s):
+    """values of CHART_TEMPLATE placeholders"""
+    tm_now = time.time()
+    bucket_s = bucket_for_span(interval_s)
+    try:
+        results = fetch_parallel(db, {'dryingfan': lambda cursor: read_buckets(cursor, device, bucket_s,
+                                                                               tm_now - interval_s, tm_now)})
+        buckets = results['dryingfan']
     except mysql.connector.Error as err:
-        rsp = err.msg
-    return rsp
+        logging.error('dryingfan chart failed: %s' % err.msg)
+        buckets = []
+
+    def series(column, y_format='%.1f'):
+        return timeseries_csv([(row[0], row[column]) for row in buckets if row[column] is not None], y_format)
+
+    def latest(column, value_format):
+        values = [row[column] for row in buckets if row[column] is not None]
+        return value_format % values[-1] if len(values) > 0 else 'n/a'
+
+    return dict(
+        DEVICE=device,
+        STATE='%sC out, %sC in, fan %s' % (latest(1, '%.1f'), latest(4, '%.1f'), latest(9, '%d%%')),
+        BUCKET='%d minutes' % (bucket_s // 60) if bucket_s < 3600 else '%d hours' % (bucket_s // 3600),
+        TEMPERATURE_OUT=series(1), TEMPERATURE_OUT_MIN=series(2), TEMPERATURE_OUT_MAX=series(3),
+        TEMPERATURE_IN=series(4), TEMPERATURE_IN_MIN=series(5), TEMPERATURE_IN_MAX=series(6),
+        ABS_OUT=series(7), ABS_IN=series(8), FAN_PCT=series(9, '%d'))
+
+
+def bucket_for_span(span_s):
+    for bucket_s in BUCKETS_S:
+        if span_s / bucket_s <= CHART_BUCKETS:
+            return bucket_s
+    return BUCKETS_S[-1]
+
+
+def read_buckets(cursor, device, bucket_s, tm_from, tm_to):
+    """aggregates per bucket computed by the database, rows of (bucket middle, avg, min and max temperature out,
+       the same in, average absolute humidity out and in, percentage of readings with fan on)"""
+    cursor.execute("SELECT time_ms DIV %d * %d + %d,"
+                   "       AVG(temperature_out), MIN(temperature_out), MAX(temperature_out),"
+                   "       AVG(temperature_in), MIN(temperature_in), MAX(temperature_in),"
+                   "       AVG(abs_out), AVG(abs_in), 100 * AVG(fan = 'Y')"
+                   "  FROM dryingfan"
+                   " WHERE device = %%s AND time_ms BETWEEN %%s AND %%s"
+                   " GROUP BY time_ms DIV %d ORDER BY 1"
+                   % (bucket_s, bucket_s, bucket_s // 2, bucket_s),
+                   (device, int(tm_from), int(tm_to)))
+    return [tuple(float(value) if value is not None else None for value in row) for row in cursor]
 
 
 def abs_humidity(T, h):
@@ -88,11 +180,60 @@ def abs_humidity(T, h):
        based on: https://www.easycalculation.com/weather/learn-relative-humidity-from-absolute.php"""
     if T is None or h is None:
         return None
+    return h/100.0 * saturated_g_m3(T)
+
+
+def saturated_g_m3(T):
+    """absolute humidity of saturated air [g/m3] at temperature T [C]"""
     M = 18.0 # [g/mol]
     R = 0.0623665 # [ mmHg x m3 / C / mol ]
     TK = 273.15 + T # [K]
     ps = ( 0.61078 * 7.501 ) * math.exp ( (17.2694 * T) / (238.3 + T) ) # [mmHg]
-    return h/100.0 * (M / (R * TK) * ps)
+    return M / (R * TK) * ps
+
+
+def abs_humidities(temperatures, humidities):
+    """abs_humidity of many readings, the exponential is computed once per distinct temperature (sensors report
+       tenths of degree, so a batch has few of them)"""
+    saturated = dict()
+    result = []
+    for (T, h) in zip(temperatures, humidities):
+        if T is None or h is None:
+            result.append(None)
+            continue
+        if T not in saturated:
+            saturated[T] = saturated_g_m3(T)
+        result.append(h/100.0 * saturated[T])
+    return result
+
+
+def backfill_derived(db):
+    """compute abs_out, abs_in and fan of rows stored before they were derived at insert, BACKFILL_BATCH rows per
+       transaction so that the table is not locked for long"""
+    last_key, n_rows = ('', -1), 0
+    try:
+        cursor = db.db.cursor()
+        while True:
+            cursor.execute("SELECT device, time_ms, temperature_out, humidity_out, temperature_in, humidity_in"
+                           "  FROM dryingfan"
+                           " WHERE (device, time_ms) > (%s, %s) AND fan IS NULL"
+                           " ORDER BY device, time_ms LIMIT %s", last_key + (BACKFILL_BATCH,))
+            rows = cursor.fetchall()
+            if len(rows) == 0:
+                break
+            abs_out = abs_humidities([row[2] for row in rows], [row[3] for row in rows])
+            abs_in = abs_humidities([row[4] for row in rows], [row[5] for row in rows])
+            cursor.executemany("UPDATE dryingfan SET abs_out = %s, abs_in = %s, fan = %s"
+                               " WHERE device = %s AND time_ms = %s",
+                               [(a_out, a_in, fan_flag(a_out, a_in), row[0], row[1])
+                                for (row, a_out, a_in) in zip(rows, abs_out, abs_in)])
+            db.db.commit()
+            last_key, n_rows = (rows[-1][0], rows[-1][1]), n_rows + len(rows)
+            print("  %d rows" % n_rows)
+        cursor.close()
+    except mysql.connector.Error as err:
+        print("  " + err.msg)
+        db.rollback(err)
 
 
 def main():
@@ -102,16 +243,21 @@ def main():
 
     if len(sys.argv) > 1:
         if sys.argv[1] == 'create_tables':
-            db.create("CREATE TABLE dryingfan"
-                      "(time_ms INT UNSIGNED NOT NULL, temperature_out FLOAT, humidity_out INT, temperature_in FLOAT, humidity_in INT,"
-                      "PRIMARY KEY (time_ms));")
+            print("tables and indexes are created by: python water/migrations.py migrate")
+            return
+        if sys.argv[1] == 'backfill_derived':
+            backfill_derived(db)
             return
 
-    print(table_environment(db))
+    print(''.join(table_environment(db, DEFAULT_DEVICE)))
 
 
 if __name__ == "__main__":
-    from jawsdb import JawsDB, timeseries_csv
+    from jawsdb import JawsDB, timeseries_csv, stream_pre, page_params, next_page_link, device_param, fetch_parallel, \
+        reading_time, PAGE_LIMIT, DEFAULT_DEVICE
+    import template
     main()
 else:
-    from .jawsdb import JawsDB, timeseries_csv
+    from .jawsdb import JawsDB, timeseries_csv, stream_pre, page_params, next_page_link, device_param, fetch_parallel, \
+        reading_time, PAGE_LIMIT, DEFAULT_DEVICE
+    from . import ingest, template
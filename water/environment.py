@@ -4,14 +4,16 @@ import time
 
 CHART_TEMPLATE = 'chart_environment.html'
 INTERVAL_PAST_S = 3*24*3600
+COLUMNS = ('temperature_c', 'humidity_pct', 'moisture_res')  # of environment table, after device and time_ms
 
 
 def handle_get(url, params, wfile):
-    db = JawsDB()
-    offset_ms, temperature_C, humidity_pct, moisture_res = 0, None, None, None
+    db = None
+    temperature_C, humidity_pct, moisture_res = None, None, None
     rsp = ""
 
     logging.info('waterbag.handle_get urlparse:%s; parse_qs: %s' % (url, params))
+    device = device_param(params)
     interval_s = INTERVAL_PAST_S
     if 'days' in params and int(params['days'][0]) > 0:
         interval_s = int(params['days'][0]) * 24 * 3600
@@ -24,94 +26,107 @@ def handle_get(url, params, wfile):
         humidity_pct = int(params['insert_humidity'][0])
     if 'insert_moisture' in params:
         moisture_res = int(params['insert_moisture'][0])
-    if 'offset_ms' in params:
-        offset_ms = int(params['offset_ms'][0])
 
     if temperature_C is not None or humidity_pct is not None or moisture_res is not None:
-        insert_environment(db, offset_ms, temperature_C, humidity_pct, moisture_res)
+        if ingest.QUEUE is not None:
+            ingest.QUEUE.submit(device, reading_time(params, time.time()), params)
+        else:
+            db = JawsDB()
+            insert_environment(db, device, reading_time(params, time.time()), temperature_C, humidity_pct, moisture_res)
         rsp += 'OK'
     elif url.path.endswith('table'):
-        rsp += "<pre>" + table_environment(db) + "</pre>\n"
+        before, limit = page_params(params)
+        db = JawsDB()
+        next_href = 'table?device=' + device + '&before=%d&limit=%d'
+        stream_pre(wfile, table_environment(db, device, before, limit, next_href))
+        db.close()
+        return
     elif url.path.endswith('chart') or url.path == '/environment':
-        rsp += chart_environment(db, interval_s)
+        db = JawsDB()
+        values = chart_values(db, device, interval_s)
+        db.close()
+        template.get(CHART_TEMPLATE).render(wfile, values)
+        return
     else:
         rsp = "UNKNOWN REQUEST"
 
+    if db is not None:
+        db.close()
     wfile.write(bytes(rsp, 'utf-8'))
 
 
-def insert_environment(db, offset_ms, temperature_c, humidity_pct, moisture_res):
-    time_ms = time.time() + offset_ms
-
-    if temperature_c is not None:
-        db.insert('temperature', 'time_ms, temperature_c', '%s, %s', (time_ms, temperature_c))
-    if humidity_pct is not None:
-        db.insert('humidity', 'time_ms, humidity_pct', '%s, %s', (time_ms, humidity_pct))
-    if moisture_res is not None:
-        db.insert('moisture', 'time_ms, moisture_res', '%s, %s', (time_ms, moisture_res))
+def insert_environment(db, device, tm, temperature_c, humidity_pct, moisture_res):
+    """one row per reading taken at tm, values sent separately within the same second are merged into one row"""
+    db.insert('environment', 'device, time_ms, ' + ', '.join(COLUMNS), '%s, %s, %s, %s, %s',
+              (device, int(tm), temperature_c, humidity_pct, moisture_res), merge_names=COLUMNS)
 
 
-def table_environment(db):
-    """return list of temperature and humidity measurements in pre-tags"""
-    rsp = ""
+def table_environment(db, device, before=None, limit=None, next_href=None):
+    """generate lines of temperature and humidity measurements older than before, newest first,
+       ends with link to next page if next_href is given"""
+    limit = limit if limit is not None else PAGE_LIMIT
+    cursor = None
     try:
         cursor = db.db.cursor()
-        query = ("SELECT t.time_ms, temperature_c, humidity_pct, moisture_res"
-                 "  FROM temperature t"
-                 "  LEFT JOIN humidity h ON t.time_ms = h.time_ms"
-                 "  LEFT JOIN moisture m ON t.time_ms = m.time_ms"
-                 " ORDER BY time_ms desc")
-        cursor.execute(query)
+        cursor.execute("SELECT time_ms, temperature_c, humidity_pct, moisture_res FROM environment"
+                       " WHERE device = %s AND time_ms < %s"
+                       " ORDER BY time_ms desc LIMIT %s",
+                       (device, before if before is not None else 2**32, limit))
 
+        n_rows, last_ts = 0, None
         for (time_ms, temperature_c, humidity_pct, moisture_res) in cursor:
-            rsp += "\n%s  %s  %s  %s" % (time.strftime("%a %d.%m. %X", time.localtime(time_ms)),
+            yield "\n%s  %s  %s  %s" % (time.strftime("%a %d.%m. %X", time.localtime(time_ms)),
                                           '%5.1fC' % temperature_c if temperature_c is not None else '  n/a ',
                                           '%3d%%' % humidity_pct if humidity_pct is not None else 'n/a ',
                                           '%3d%%' % moisture_to_pct(moisture_res) if moisture_res is not None else 'n/a ')
-
-        cursor.close()
+            n_rows, last_ts = n_rows + 1, time_ms
+        yield next_page_link(next_href, last_ts, n_rows, limit)
     except mysql.connector.Error as err:
-        rsp = err.msg
-    return rsp
+        db.failed(err)
+        yield err.msg
+    finally:
+        if cursor is not None:
+            cursor.close()
 
 
-def chart_environment(db, interval_s):
+def chart_values(db, device, interval_s):
+    """values of CHART_TEMPLATE placeholders"""
     tm_now = time.time()
-    (temperature, humidity, moisture) = get_data(db, tm_now - interval_s, tm_now)
-    with open(CHART_TEMPLATE, 'r') as template_file:
-        return template_file.read()\
-            .replace('%STATE%', '%dC %d%% soil moisture' % (temperature[-1][1], moisture[-1][1]))\
-            .replace('%TEMPERATURE%', timeseries_csv(temperature)) \
-            .replace('%HUMIDITY%', timeseries_csv(humidity)) \
-            .replace('%MOISTURE%', timeseries_csv(moisture))
+    (temperature, humidity, moisture) = get_data(db, device, tm_now - interval_s, tm_now)
+    return dict(
+        DEVICE=device,
+        STATE='%dC %d%% soil moisture' % (temperature[-1][1], moisture[-1][1]),
+        TEMPERATURE=timeseries_csv(temperature),
+        HUMIDITY=timeseries_csv(humidity),
+        MOISTURE=timeseries_csv(moisture))
 
 
-def get_data(db, tm_from, tm_to):
-    """returns:
+def get_data(db, device, tm_from, tm_to):
+    """returns for the device:
        - time series [{t,temperature}]
        - time series [{t,air humidity}]
        - time series [{t,soil moisture}]"""
     try:
-        cursor = db.db.cursor()
-
-        temperature = read_timeseries(cursor, 'temperature', tm_from, tm_to)
-        humidity = read_timeseries(cursor, 'humidity', tm_from, tm_to)
-        moisture = [ (t, moisture_to_pct(m)) for (t, m) in read_timeseries(cursor, 'moisture', tm_from, tm_to) ]
-
-        cursor.close()
-        return (temperature, humidity, moisture)
+        results = fetch_parallel(db, {'environment': lambda cursor: read_environment(cursor, device, tm_from, tm_to)})
+        return results['environment']  # timed like the series of other pages
     except mysql.connector.Error as err:
         return err.msg
 
 
-def read_timeseries(cursor, table, tm_from, tm_to):
-    timeseries = []
-    cursor.execute("SELECT * FROM %s"
-                   " WHERE time_ms BETWEEN %d and %d ORDER BY time_ms"
-                   % (table, tm_from, tm_to))
-    for (time_ms, value) in cursor:
-        timeseries.append((time_ms, value))
-    return timeseries
+def read_environment(cursor, device, tm_from, tm_to):
+    """all three series from one range scan, a reading may lack some of the values"""
+    temperature, humidity, moisture = [], [], []
+    cursor.execute("SELECT time_ms, temperature_c, humidity_pct, moisture_res FROM environment"
+                   " WHERE device = %s AND time_ms BETWEEN %s and %s ORDER BY time_ms",
+                   (device, int(tm_from), int(tm_to)))
+    for (time_ms, temperature_c, humidity_pct, moisture_res) in cursor:
+        if temperature_c is not None:
+            temperature.append((time_ms, temperature_c))
+        if humidity_pct is not None:
+            humidity.append((time_ms, humidity_pct))
+        if moisture_res is not None:
+            moisture.append((time_ms, moisture_to_pct(moisture_res)))
+    return (temperature, humidity, moisture)
 
 
 def moisture_to_pct(resistance):
@@ -125,24 +140,20 @@ def main():
 
     if len(sys.argv) > 1:
         if sys.argv[1] == 'insert_environment':
-            insert_environment(db, 0, int(sys.argv[2]) if len(sys.argv) >= 3 else 22, int(sys.argv[3]) if len(sys.argv) >= 4 else 55)
+            insert_environment(db, DEFAULT_DEVICE, time.time(), int(sys.argv[2]) if len(sys.argv) >= 3 else 22, int(sys.argv[3]) if len(sys.argv) >= 4 else 55)
         if sys.argv[1] == 'create_tables':
-            db.create("CREATE TABLE temperature "
-                      "(time_ms INT UNSIGNED NOT NULL, temperature_c FLOAT NOT NULL, "
-                      "PRIMARY KEY (time_ms));")
-            db.create("CREATE TABLE humidity "
-                      "(time_ms INT UNSIGNED NOT NULL, humidity_pct INT NOT NULL, "
-                      "PRIMARY KEY (time_ms));")
-            db.create("CREATE TABLE moisture "
-                      "(time_ms INT UNSIGNED NOT NULL, moisture_res INT NOT NULL, "
-                      "PRIMARY KEY (time_ms));")
+            print("tables and indexes are created by: python water/migrations.py migrate")
             return
 
-    print(table_environment(db))
+    print(''.join(table_environment(db, DEFAULT_DEVICE)))
 
 
 if __name__ == "__main__":
-    from jawsdb import JawsDB, timeseries_csv
+    from jawsdb import JawsDB, timeseries_csv, stream_pre, page_params, next_page_link, device_param, fetch_parallel, \
+        reading_time, PAGE_LIMIT, DEFAULT_DEVICE
+    import template
     main()
 else:
-    from .jawsdb import JawsDB, timeseries_csv
+    from .jawsdb import JawsDB, timeseries_csv, stream_pre, page_params, next_page_link, device_param, fetch_parallel, \
+        reading_time, PAGE_LIMIT, DEFAULT_DEVICE
+    from . import template, ingest
@@ -0,0 +1,80 @@
+"""currently valid rain forecast in memory: slots sorted by time with cumulative rain, rebuilt whenever a new forecast
+is stored, so that the rain expected between two times and the cumulative forecast curve need no database query"""
+
+import bisect
+import logging
+import mysql.connector
+import threading
+import time
+
+INDEX = None  # ForecastIndex of the stored forecast, loaded on first use
+LOAD_LOCK = threading.Lock()
+
+
+class ForecastIndex:
+    """slots (start, end, rain_mm) sorted by start and not overlapping, cum[k] is the rain of the slots before k;
+       a slot counts proportionally to the part of it inside the asked interval"""
+
+    def __init__(self, slots):
+        self.start = [int(slot[0]) for slot in slots]
+        self.end = [int(slot[1]) for slot in slots]
+        self.rain = [float(slot[2]) for slot in slots]
+        self.cum = [0.0]
+        for mm in self.rain:
+            self.cum.append(self.cum[-1] + mm)
+
+    def cumulative(self, tm):
+        """rain forecasted from the first slot until tm"""
+        k = bisect.bisect_right(self.start, tm) - 1
+        if k < 0:
+            return 0.0
+        length = self.end[k] - self.start[k]
+        part = min(1.0, float(tm - self.start[k]) / length) if length > 0 else 1.0
+        return self.cum[k] + self.rain[k] * part
+
+    def rain_between(self, tm_from, tm_to):
+        return max(0.0, self.cumulative(tm_to) - self.cumulative(tm_from))
+
+    def curve(self, tm_from, tm_to):
+        """[(time, rain since tm_from)] at tm_from, at the end of every slot in between and at tm_to if the forecast
+           reaches it"""
+        base = self.cumulative(tm_from)
+        points = [(tm_from, 0.0)]
+        k = bisect.bisect_right(self.end, tm_from)
+        while k < len(self.end) and self.end[k] < tm_to:
+            points.append((self.end[k], self.cum[k + 1] - base))
+            k += 1
+        if k < len(self.end) and self.start[k] < tm_to:
+            points.append((tm_to, self.cumulative(tm_to) - base))
+        return points
+
+
+def get(db):
+    """index of the stored forecast, read from the database if it was not loaded yet"""
+    if INDEX is None:
+        load(db)
+    return INDEX if INDEX is not None else ForecastIndex([])
+
+
+def load(db):
+    """(re)build the index from the currently valid forecast, call after a new forecast is stored"""
+    global INDEX
+    if db.db is None:
+        logging.error('forecast index not loaded, no database connection')
+        return False
+    with LOAD_LOCK:
+        try:
+            cursor = db.db.cursor()
+            cursor.execute("SELECT forecast_from, forecast_to, rain_mm FROM forecast"
+                           " WHERE valid_to >= %s ORDER BY forecast_from, valid_from", (int(time.time()),))
+            slots = dict()
+            for (forecast_from, forecast_to, rain_mm) in cursor:
+                slots[forecast_from] = (forecast_from, forecast_to, rain_mm or 0)  # the newest one of a slot wins
+            cursor.close()
+        except mysql.connector.Error as err:
+            db.failed(err)
+            logging.error('forecast index not loaded: %s' % err.msg)
+            return False
+        INDEX = ForecastIndex(sorted(slots.values()))
+        logging.info('forecast index of %d slots loaded' % len(INDEX.start))
+        return True
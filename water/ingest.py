@@ -0,0 +1,181 @@
+"""write-behind ingest: readings are appended to a local journal and acknowledged at once, a background thread
+stores them in the database in group commits (every FLUSH_MS milliseconds or FLUSH_ROWS readings) and deletes the
+journal once they are committed; journal left by a crash or a database outage is stored at the next start.
+Handlers check out a database connection only when they do not queue, so readings are acknowledged also while the
+database is down"""
+
+import glob
+import json
+import logging
+import mysql.connector
+import os
+import threading
+import time
+import urllib
+
+from . import batch
+from .jawsdb import JawsDB, strtime
+from .waterbag import check_forecast
+
+FLUSH_MS = int(os.environ.get('INGEST_FLUSH_MS', 500))  # 0 = no queue, readings are inserted before the response
+FLUSH_ROWS = int(os.environ.get('INGEST_FLUSH_ROWS', 200))
+JOURNAL_DIR = os.environ.get('INGEST_JOURNAL_DIR', 'journal')
+FSYNC = os.environ.get('INGEST_FSYNC', '0') == '1'  # survive also power loss, at the cost of a disk sync per reading
+RETRY_MAX_S = 60  # flush retry delay doubles up to this while the database is not available
+
+QUEUE = None  # IngestQueue started by the server
+
+
+class IngestQueue(threading.Thread):
+    """journal is split in numbered segments, a new one is started with every flush and the flushed ones are deleted
+       after commit; rows committed just before a crash are replayed again and recognized as duplicates"""
+
+    def __init__(self, cfg, journal_dir, flush_ms, flush_rows):
+        threading.Thread.__init__(self, name='ingest')
+        self.daemon = True
+        self.cfg = cfg
+        self.journal_dir = journal_dir
+        self.flush_s = flush_ms / 1000.0
+        self.flush_rows = flush_rows
+        self.cond = threading.Condition()
+        self.pending = []  # (device, time, query string of insert_* parameters)
+        self.segments = []  # paths of closed journal segments holding pending entries
+        self.segment_no = 0
+        self.journal = None
+        self.journal_entries = 0  # entries written to the current segment
+        self.stopping = False
+        self.stats = dict(queued=0, stored=0, flushes=0, failures=0, replayed=0, last_flush=None, last_flush_ms=None)
+        os.makedirs(journal_dir, exist_ok=True)
+        self.replay()
+        self.open_segment()
+
+    def replay(self):
+        for path in sorted(glob.glob(os.path.join(self.journal_dir, 'ingest.*.journal'))):
+            with open(path) as journal:
+                for line in journal:
+                    try:
+                        self.pending.append(tuple(json.loads(line)))
+                    except ValueError:
+                        logging.warning('incomplete journal line skipped in %s' % path)  # write cut by crash
+            self.segments.append(path)
+            self.segment_no = max(self.segment_no, int(path.split('.')[-2]))
+        self.stats['replayed'] = len(self.pending)
+        if len(self.pending) > 0:
+            logging.info('%d readings replayed from journal' % len(self.pending))
+
+    def open_segment(self):
+        self.segment_no += 1
+        self.journal = open(os.path.join(self.journal_dir, 'ingest.%08d.journal' % self.segment_no), 'a')
+        self.journal_entries = 0
+
+    def submit(self, device, tm, params):
+        """journal the insert_* request parameters of a reading taken at time tm and queue it for the database"""
+        entry = (device, int(tm), urllib.parse.urlencode(
+            [(key, value) for (key, values) in params.items() if key.startswith('insert_') for value in values]))
+        with self.cond:
+            self.journal.write(json.dumps(entry) + '\n')
+            self.journal.flush()
+            if FSYNC:
+                os.fsync(self.journal.fileno())
+            self.journal_entries += 1
+            self.pending.append(entry)
+            self.stats['queued'] += 1
+            if len(self.pending) == self.flush_rows:
+                self.cond.notify()
+
+    def stop(self, timeout_s=10):
+        """flush what is queued and stop, readings not stored by then stay in the journal"""
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        self.join(timeout_s)
+
+    def run(self):
+        logging.info('ingest queue running, flush every %dms or %d readings' % (self.flush_s * 1000, self.flush_rows))
+        delay_s, retry = self.flush_s, False
+        while True:
+            with self.cond:
+                if not self.stopping and (retry or len(self.pending) < self.flush_rows):
+                    self.cond.wait(delay_s)
+                if len(self.pending) == 0:
+                    if self.stopping:
+                        return
+                    continue
+                entries, segments = self.pending, self.segments
+                if self.journal_entries > 0:  # retries during an outage must not leave empty segments behind
+                    segments = segments + [self.journal.name]
+                    self.journal.close()
+                    self.open_segment()
+                self.pending, self.segments = [], []
+
+            try:
+                stored = self.flush(entries)
+            except Exception:  # the thread must survive anything, otherwise readings are acknowledged but not stored
+                logging.exception('ingest flush of %d readings failed' % len(entries))
+                self.stats['failures'] += 1
+                stored = False
+            if stored:
+                for path in segments:
+                    try:
+                        os.remove(path)
+                    except OSError as err:  # stored already, replayed as duplicates at the next start
+                        logging.error('journal segment %s not removed: %s' % (path, err))
+                delay_s, retry = self.flush_s, False
+            else:
+                with self.cond:  # keep order, newer readings may have arrived meanwhile
+                    self.pending = entries + self.pending
+                    self.segments = segments + self.segments
+                delay_s, retry = min(max(2 * delay_s, 1), RETRY_MAX_S), True
+                if self.stopping:
+                    return  # stored at the next start
+
+    def flush(self, entries):
+        """store entries in one transaction per device, False if the database failed"""
+        tm_start = time.time()
+        by_device = dict()
+        for (device, tm, query) in entries:
+            by_device.setdefault(device, []).append('%s&time=%d' % (query, tm))
+        db = JawsDB()
+        try:
+            if db.db is None:
+                raise mysql.connector.Error(msg='no database connection')
+            for (device, lines) in by_device.items():
+                rows = dict((table, []) for (table, _, _) in batch.TABLES)
+                for (i, line) in enumerate(lines):
+                    try:
+                        batch.parse_line(line, int(time.time()), i, rows)
+                    except ValueError as err:
+                        logging.error('reading of %s dropped, %s: %s' % (device, err, line))
+                batch.store(db, device, rows)
+                if len(rows['height']) > 0:
+                    try:  # the readings are committed, a bad configuration must not make them retried
+                        check_forecast(self.cfg, db, max(rows['height'], key=lambda row: row[1])[2][0])
+                    except Exception:
+                        logging.exception('check_forecast of %s failed' % device)
+        except mysql.connector.Error as err:
+            db.rollback(err)
+            logging.error('ingest flush of %d readings failed: %s' % (len(entries), err.msg))
+            self.stats['failures'] += 1
+            return False
+        finally:
+            db.close()
+        self.stats['stored'] += len(entries)
+        self.stats['flushes'] += 1
+        self.stats['last_flush'] = strtime(time.time())
+        self.stats['last_flush_ms'] = int(1000 * (time.time() - tm_start))
+        return True
+
+
+def start_queue(cfg):
+    global QUEUE
+    if FLUSH_MS <= 0:
+        return None
+    QUEUE = IngestQueue(cfg, JOURNAL_DIR, FLUSH_MS, FLUSH_ROWS)
+    QUEUE.start()
+    return QUEUE
+
+
+def stop_queue():
+    if QUEUE is not None:
+        QUEUE.stop()
+
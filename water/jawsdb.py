@@ -1,36 +1,196 @@
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import mysql.connector
 from mysql.connector import errorcode
 import os
+import re
+import threading
 import time
 
+POOL_SIZE = int(os.environ.get('JAWSDB_POOL_SIZE', 4))  # free JawsDB plan allows 10 connections
+POOL_IDLE_S = int(os.environ.get('JAWSDB_POOL_IDLE_S', 300))  # close connections unused for longer
+POOL_WAIT_S = int(os.environ.get('JAWSDB_POOL_WAIT_S', 10))  # how long to wait for a free connection
+POOL_PING_IDLE_S = 30  # connections idle for longer are pinged before use, recently used ones are trusted
+STREAM_CHUNK = 100  # lines per socket write when streaming tables
+PAGE_LIMIT = 1000  # default rows per page of table views
+INSERT_CHUNK = 500  # rows per multi-row INSERT, keeps statements well below max_allowed_packet
+DEFAULT_DEVICE = 'default'  # requests without device parameter, and all data from before multiple devices
+DEVICE_UNSAFE = re.compile(r'[^A-Za-z0-9_-]')
+CONNECTION_LOST = (errorcode.CR_SERVER_GONE_ERROR, errorcode.CR_SERVER_LOST, errorcode.CR_SERVER_LOST_EXTENDED)
 
-class JawsDB:
 
-    def __init__(self):
-        db_config = dict(
-            host=os.environ['JAWSDB_HOST'],
-            user=os.environ['JAWSDB_USER'],
-            passwd=os.environ['JAWSDB_PASSWD'],
-            database=os.environ['JAWSDB_DATABASE']
-        )
+def connect():
+    db_config = dict(
+        host=os.environ['JAWSDB_HOST'],
+        user=os.environ['JAWSDB_USER'],
+        passwd=os.environ['JAWSDB_PASSWD'],
+        database=os.environ['JAWSDB_DATABASE']
+    )
 
-        try:
-            self.db = mysql.connector.connect(**db_config)
-            logging.info("Database %s/%s connected" % (db_config['host'], db_config['database']))
-        except mysql.connector.Error as err:
-            if err.errno == errorcode.ER_ACCESS_DENIED_ERROR:
-                print("Something is wrong with your database user name or password")
-            elif err.errno == errorcode.ER_BAD_DB_ERROR:
-                print("Database does not exist")
+    try:
+        conn = mysql.connector.connect(**db_config)
+        logging.info("Database %s/%s connected" % (db_config['host'], db_config['database']))
+        return conn
+    except mysql.connector.Error as err:
+        if err.errno == errorcode.ER_ACCESS_DENIED_ERROR:
+            print("Something is wrong with your database user name or password")
+        elif err.errno == errorcode.ER_BAD_DB_ERROR:
+            print("Database does not exist")
+        else:
+            print(err)
+        return None
+
+
+class ConnectionPool:
+    """process-wide pool of database connections, at most max_size of them are open at any time"""
+
+    def __init__(self, max_size, idle_s, wait_s):
+        self.max_size = max_size
+        self.idle_s = idle_s
+        self.wait_s = wait_s
+        self.idle = []  # (released_at, connection), most recently released last
+        self.n_open = 0
+        self.cond = threading.Condition()
+        self.counters = dict(checkouts=0, waits=0, timeouts=0, connects=0, reconnects=0, idle_closed=0,
+                             fetch_sequential=0)
+
+    def checkout(self, wait_s=None):
+        """return live connection or None if it cannot be opened or none is free within wait_s (default of the pool);
+           wait_s=0 only tries, finding no free connection then is expected and not counted as a timeout"""
+        wait_s = wait_s if wait_s is not None else self.wait_s
+        deadline = time.time() + wait_s
+        with self.cond:
+            self.close_idle()
+            while len(self.idle) == 0 and self.n_open >= self.max_size:
+                if wait_s <= 0:
+                    return None
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.counters['timeouts'] += 1
+                    logging.warning('no free database connection within %ds' % wait_s)
+                    return None
+                self.counters['waits'] += 1
+                self.cond.wait(remaining)
+            self.counters['checkouts'] += 1
+            released_at = None
+            if len(self.idle) > 0:
+                released_at, conn = self.idle.pop()
             else:
-                print(err)
-            self.db = None
+                conn = None
+                self.n_open += 1
+
+        try:
+            if conn is None:
+                conn = connect()
+                with self.cond:
+                    self.counters['connects'] += 1
+            elif released_at < time.time() - POOL_PING_IDLE_S and not self.alive(conn):
+                with self.cond:
+                    self.counters['reconnects'] += 1
+                conn = connect()
+        except Exception:
+            self.discard()  # e.g. missing configuration, the slot must not stay taken
+            raise
+        if conn is None:
+            self.discard()
+        return conn
+
+    def release(self, conn, lost=False):
+        """return connection for reuse, unless a statement on it lost the connection: in_transaction only reflects
+           the last packet received, so a dead connection would look idle and be reused until POOL_PING_IDLE_S"""
+        if lost:
+            self.discard(conn)
+            return
+        try:
+            if conn.in_transaction:
+                conn.rollback()  # do not leak open transaction (and its stale snapshot) to the next user
+        except mysql.connector.Error:
+            self.discard(conn)
+            return
+        with self.cond:
+            self.idle.append((time.time(), conn))
+            self.cond.notify()
+
+    def discard(self, conn=None):
+        """forget connection which is broken or could not be opened"""
+        if conn is not None:
+            try:
+                conn.close()
+            except mysql.connector.Error:
+                pass
+        with self.cond:
+            self.n_open -= 1
+            self.cond.notify()
+
+    def close_idle(self):
+        """close connections idle for more than idle_s, the oldest ones are at the start of the list"""
+        now = time.time()
+        while len(self.idle) > 0 and self.idle[0][0] < now - self.idle_s:
+            _, conn = self.idle.pop(0)
+            self.n_open -= 1
+            self.counters['idle_closed'] += 1
+            try:
+                conn.close()
+            except mysql.connector.Error:
+                pass
+
+    @staticmethod
+    def alive(conn):
+        try:
+            conn.ping(reconnect=False)
+            return True
+        except mysql.connector.Error:
+            try:
+                conn.close()
+            except mysql.connector.Error:
+                pass
+            return False
+
+    def stats(self):
+        with self.cond:
+            return dict(self.counters, open=self.n_open, idle=len(self.idle), max_size=self.max_size)
+
+
+POOL = ConnectionPool(POOL_SIZE, POOL_IDLE_S, POOL_WAIT_S)
+
+
+class JawsDB:
+    """database connection borrowed from POOL, returned by close() or when the object is garbage collected;
+       handlers close it before writing the response, so that a slow client does not keep a connection busy"""
+
+    def __init__(self, wait_s=None):
+        self.db = None
+        self.lost = False
+        self.db = POOL.checkout(wait_s)
 
     def __del__(self):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
         if self.db is not None:
-            print("Closing database")
-            self.db.close()
+            POOL.release(self.db, self.lost)
+            self.db = None
+
+    def failed(self, err):
+        """note error of a statement, a connection lost by it is not returned to the pool"""
+        if err.errno in CONNECTION_LOST:
+            self.lost = True
+
+    def rollback(self, err):
+        """roll back after a failed statement"""
+        self.failed(err)
+        if self.db is None or self.lost:
+            return
+        try:
+            self.db.rollback()
+        except mysql.connector.Error:
+            self.lost = True
 
     def create(self, table_def):
         cursor = self.db.cursor()
@@ -46,20 +206,29 @@ class JawsDB:
             print("  OK")
         cursor.close()
 
-    def insert(self, table, attr_names_csv, attr_format_csv, args_ntuple):
-        """insert n-tuple or list of n-tuples"""
+    def insert(self, table, attr_names_csv, attr_format_csv, args_ntuple, commit=True, merge_names=None):
+        """insert n-tuple or list of n-tuples, lists are sent as multi-row INSERTs of up to INSERT_CHUNK rows;
+           with commit=False the caller commits, e.g. to make the insert part of larger transaction;
+           with merge_names a row with existing key is updated, its attributes of merge_names are replaced by those
+           of the new row which are not NULL"""
         if self.db is None:
             return False
         try:
             cursor = self.db.cursor()
             list_ntuples = args_ntuple if isinstance(args_ntuple, list) else [args_ntuple]
-            for rec in list_ntuples:
-                cursor.execute("INSERT INTO %s (%s) VALUES (%s)" % (table, attr_names_csv, attr_format_csv), rec)
-            self.db.commit()
+            query = "INSERT INTO %s (%s) VALUES (%s)" % (table, attr_names_csv, attr_format_csv)
+            if merge_names is not None:
+                query += " ON DUPLICATE KEY UPDATE " + ', '.join(
+                    ["%s = COALESCE(VALUES(%s), %s)" % (name, name, name) for name in merge_names])
+            for start in range(0, len(list_ntuples), INSERT_CHUNK):
+                cursor.executemany(query, list_ntuples[start:start + INSERT_CHUNK])  # rewritten to one multi-row INSERT
+            if commit:
+                self.db.commit()
             cursor.close()
             return True
         except mysql.connector.Error as err:
             print("  " + err.msg)
+            self.rollback(err)
             return False
 
     def delete_all(self, table):
@@ -69,16 +238,133 @@ class JawsDB:
             cursor.execute("DELETE FROM %s" % table)
             self.db.commit()
         except mysql.connector.Error as err:
+            self.failed(err)
             print("  " + err.msg)
         else:
             print("  OK")
         cursor.close()
 
 
+FETCH_EXECUTOR = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix='fetch')
+TIMINGS = dict()  # reader name: dict(n, total_ms, max_ms, last_ms)
+TIMINGS_LOCK = threading.Lock()
+
+
+def fetch_parallel(db, readers):
+    """run readers (name: function of cursor returning its result) concurrently, the first one on db, the others on
+       connections from POOL; a reader for which no connection is free right now runs on db after the first one,
+       so that concurrent pages cannot exhaust the pool; return dict name: result, raise error of any reader"""
+    names = list(readers)
+    futures, sequential = dict(), []
+    for name in names[1:]:
+        conn = JawsDB(wait_s=0)
+        if conn.db is None:
+            conn.close()
+            sequential.append(name)
+            with POOL.cond:
+                POOL.counters['fetch_sequential'] += 1
+        else:
+            futures[name] = FETCH_EXECUTOR.submit(run_reader, conn, name, readers[name], True)
+    results = dict()
+    try:
+        for name in names[:1] + sequential:
+            results[name] = run_reader(db, name, readers[name])
+    finally:
+        for (name, future) in futures.items():
+            results[name] = future.result()  # wait for all, connections must not be used after the page is done
+    return results
+
+
+def run_reader(db, name, reader, release=False):
+    try:
+        if db.db is None:
+            raise mysql.connector.Error(msg='no database connection')
+        tm_start = time.time()
+        cursor = db.db.cursor()
+        result = reader(cursor)
+        cursor.close()
+        record_timing(name, time.time() - tm_start)
+        return result
+    except mysql.connector.Error as err:
+        db.failed(err)
+        raise
+    finally:
+        if release:
+            db.close()
+
+
+def record_timing(name, duration_s):
+    ms = 1000 * duration_s
+    with TIMINGS_LOCK:
+        timing = TIMINGS.setdefault(name, dict(n=0, total_ms=0.0, max_ms=0.0, last_ms=0.0))
+        timing['n'] += 1
+        timing['total_ms'] += ms
+        timing['max_ms'] = max(timing['max_ms'], ms)
+        timing['last_ms'] = ms
+
+
+def timing_stats():
+    """one line per reader: number of runs, average, maximum and last duration"""
+    with TIMINGS_LOCK:
+        return '\n'.join('%-20s n=%d avg=%.1fms max=%.1fms last=%.1fms'
+                         % (name, t['n'], t['total_ms'] / t['n'], t['max_ms'], t['last_ms'])
+                         for (name, t) in sorted(TIMINGS.items()))
+
+
 def strtime(tm):
     return time.strftime("%x %X", time.localtime(tm))
 
 
-def timeseries_csv(stored):
-    stored_string = '[' + ','.join(["{t:%d,y:%d}" % (1000 * sec, l) for (sec, l) in stored]) + ']'
+def device_param(params):
+    """device id from request parameters, restricted to characters safe in URLs and at most 32 characters"""
+    device = DEVICE_UNSAFE.sub('', params['device'][0])[:32] if 'device' in params else ''
+    return device if device != '' else DEFAULT_DEVICE
+
+
+def stream_lines(wfile, lines):
+    """write lines to wfile as they are produced, in chunks of STREAM_CHUNK lines"""
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= STREAM_CHUNK:
+            wfile.write(bytes(''.join(chunk), 'utf-8'))
+            chunk = []
+    if len(chunk) > 0:
+        wfile.write(bytes(''.join(chunk), 'utf-8'))
+
+
+def stream_pre(wfile, lines):
+    """stream lines wrapped in pre-tags"""
+    wfile.write(b'<pre>')
+    stream_lines(wfile, lines)
+    wfile.write(b'</pre>\n')
+
+
+def reading_time(params, tm_now):
+    """time of a reading in epoch seconds from request parameters: time, or offset_ms milliseconds relative to
+       tm_now (arrival of the request), default tm_now; the same for GET and for lines of POST /batch"""
+    if 'time' in params:
+        return int(params['time'][0])
+    if 'offset_ms' in params:
+        return tm_now + int(params['offset_ms'][0]) / 1000.0
+    return tm_now
+
+
+def page_params(params):
+    """keyset pagination parameters: rows strictly older than before (None = newest), at most limit rows"""
+    before = int(params['before'][0]) if 'before' in params else None
+    limit = int(params['limit'][0]) if 'limit' in params else PAGE_LIMIT
+    return before, max(1, limit)
+
+
+def next_page_link(next_href, last_ts, n_rows, limit):
+    """link to the following page if this one is full, last_ts is the time or the (time, id) key of its last row"""
+    if next_href is None or n_rows < limit:
+        return ''
+    key = last_ts if isinstance(last_ts, tuple) else (last_ts,)
+    return '\n\n<a href="%s">older</a>' % (next_href % (key + (limit,)))
+
+
+def timeseries_csv(stored, y_format='%d'):
+    stored_string = '[' + ','.join([("{t:%d,y:" + y_format + "}") % (1000 * sec, l) for (sec, l) in stored]) + ']'
     return stored_string
\ No newline at end of file
@@ -0,0 +1,220 @@
+"""versioned database schema: creates all tables and indexes, records applied versions in schema_version
+
+    python water/migrations.py migrate   apply migrations not applied yet (safe to run repeatedly)
+    python water/migrations.py status    print applied versions
+    python water/migrations.py explain   check that the hot queries use an index"""
+
+import mysql.connector
+from mysql.connector import errorcode
+import time
+
+# errors meaning the change is already in place, e.g. migration interrupted after some DDL (DDL is not transactional)
+ALREADY_APPLIED = (errorcode.ER_TABLE_EXISTS_ERROR, errorcode.ER_DUP_KEYNAME, errorcode.ER_DUP_FIELDNAME,
+                   errorcode.ER_CANT_DROP_FIELD_OR_KEY, errorcode.ER_MULTIPLE_PRI_KEY)
+
+MIGRATIONS = [  # (version, description, statements), append only
+    (1, 'initial tables', [
+        "CREATE TABLE IF NOT EXISTS height (time INT UNSIGNED NOT NULL, mm INT, PRIMARY KEY (time))",
+        "CREATE TABLE IF NOT EXISTS log (time INT UNSIGNED NOT NULL, msg VARCHAR(1024))",
+        "CREATE TABLE IF NOT EXISTS command (time INT UNSIGNED NOT NULL, cmd VARCHAR(1024), popped ENUM('Y','N'))",
+        "CREATE TABLE IF NOT EXISTS height_hourly (time INT UNSIGNED NOT NULL,"
+        " mm_min INT, mm_max INT, mm_sum BIGINT, n INT UNSIGNED, mm_last INT, last_time INT UNSIGNED,"
+        " PRIMARY KEY (time))",
+        "CREATE TABLE IF NOT EXISTS height_daily (time INT UNSIGNED NOT NULL,"
+        " mm_min INT, mm_max INT, mm_sum BIGINT, n INT UNSIGNED, mm_last INT, last_time INT UNSIGNED,"
+        " PRIMARY KEY (time))",
+        "CREATE TABLE IF NOT EXISTS forecast ("
+        " valid_from     INT UNSIGNED NOT NULL,"
+        " valid_to       INT UNSIGNED NOT NULL,"
+        " forecast_from  INT UNSIGNED NOT NULL,"
+        " forecast_to    INT UNSIGNED NOT NULL,"
+        " rain_mm        FLOAT,"
+        "PRIMARY KEY (valid_from, forecast_from))",
+        "CREATE TABLE IF NOT EXISTS temperature "
+        "(time_ms INT UNSIGNED NOT NULL, temperature_c FLOAT NOT NULL, PRIMARY KEY (time_ms))",
+        "CREATE TABLE IF NOT EXISTS humidity "
+        "(time_ms INT UNSIGNED NOT NULL, humidity_pct INT NOT NULL, PRIMARY KEY (time_ms))",
+        "CREATE TABLE IF NOT EXISTS moisture "
+        "(time_ms INT UNSIGNED NOT NULL, moisture_res INT NOT NULL, PRIMARY KEY (time_ms))",
+        "CREATE TABLE IF NOT EXISTS dryingfan (time_ms INT UNSIGNED NOT NULL,"
+        " temperature_out FLOAT, humidity_out INT, temperature_in FLOAT, humidity_in INT, PRIMARY KEY (time_ms))",
+    ]),
+    (2, 'indexes for hot queries', [
+        "CREATE INDEX log_time ON log (time)",
+        "CREATE INDEX command_popped_time ON command (popped, time)",
+        "CREATE INDEX forecast_valid ON forecast (valid_to, forecast_from)",
+    ]),
+    (3, 'overflow valve intervals, fill by: python water/waterbag.py backfill_overflow', [
+        "CREATE TABLE IF NOT EXISTS overflow (opened INT UNSIGNED NOT NULL, closed INT UNSIGNED NULL,"
+        " duration_s INT UNSIGNED NULL, PRIMARY KEY (opened), KEY overflow_closed (closed))",
+    ]),
+    (4, 'command queue with id, target device and delivery time', [
+        "ALTER TABLE command ADD COLUMN id INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY FIRST",
+        "ALTER TABLE command ADD COLUMN device VARCHAR(32) NULL",
+        "ALTER TABLE command ADD COLUMN delivered INT UNSIGNED NULL",
+        "CREATE INDEX command_pending ON command (popped, id)",
+    ]),
+    (5, 'device column in front of the keys, existing rows belong to the default device', [
+        "ALTER TABLE height ADD COLUMN device VARCHAR(32) NOT NULL DEFAULT 'default' FIRST",
+        "ALTER TABLE height DROP PRIMARY KEY, ADD PRIMARY KEY (device, time)",
+        "ALTER TABLE height_hourly ADD COLUMN device VARCHAR(32) NOT NULL DEFAULT 'default' FIRST",
+        "ALTER TABLE height_hourly DROP PRIMARY KEY, ADD PRIMARY KEY (device, time)",
+        "ALTER TABLE height_daily ADD COLUMN device VARCHAR(32) NOT NULL DEFAULT 'default' FIRST",
+        "ALTER TABLE height_daily DROP PRIMARY KEY, ADD PRIMARY KEY (device, time)",
+        "ALTER TABLE temperature ADD COLUMN device VARCHAR(32) NOT NULL DEFAULT 'default' FIRST",
+        "ALTER TABLE temperature DROP PRIMARY KEY, ADD PRIMARY KEY (device, time_ms)",
+        "ALTER TABLE humidity ADD COLUMN device VARCHAR(32) NOT NULL DEFAULT 'default' FIRST",
+        "ALTER TABLE humidity DROP PRIMARY KEY, ADD PRIMARY KEY (device, time_ms)",
+        "ALTER TABLE moisture ADD COLUMN device VARCHAR(32) NOT NULL DEFAULT 'default' FIRST",
+        "ALTER TABLE moisture DROP PRIMARY KEY, ADD PRIMARY KEY (device, time_ms)",
+        "ALTER TABLE dryingfan ADD COLUMN device VARCHAR(32) NOT NULL DEFAULT 'default' FIRST",
+        "ALTER TABLE dryingfan DROP PRIMARY KEY, ADD PRIMARY KEY (device, time_ms)",
+        "ALTER TABLE log ADD COLUMN device VARCHAR(32) NOT NULL DEFAULT 'default' FIRST",
+        "CREATE INDEX log_device_time ON log (device, time)",
+        "DROP INDEX log_time ON log",
+        "ALTER TABLE overflow ADD COLUMN device VARCHAR(32) NOT NULL DEFAULT 'default' FIRST",
+        "ALTER TABLE overflow DROP PRIMARY KEY, ADD PRIMARY KEY (device, opened)",
+        "CREATE INDEX overflow_device_closed ON overflow (device, closed)",
+        "DROP INDEX overflow_closed ON overflow",
+        "UPDATE command SET device = 'default' WHERE popped = 'Y' AND device IS NULL",
+    ]),
+    (6, 'environment readings in one table, copied from temperature, humidity and moisture', [
+        "CREATE TABLE IF NOT EXISTS environment (device VARCHAR(32) NOT NULL DEFAULT 'default',"
+        " time_ms INT UNSIGNED NOT NULL, temperature_c FLOAT NULL, humidity_pct INT NULL, moisture_res INT NULL,"
+        " PRIMARY KEY (device, time_ms))",
+        "INSERT INTO environment (device, time_ms, temperature_c)"
+        " SELECT device, time_ms, temperature_c FROM temperature"
+        " ON DUPLICATE KEY UPDATE temperature_c = VALUES(temperature_c)",
+        "INSERT INTO environment (device, time_ms, humidity_pct)"
+        " SELECT device, time_ms, humidity_pct FROM humidity"
+        " ON DUPLICATE KEY UPDATE humidity_pct = VALUES(humidity_pct)",
+        "INSERT INTO environment (device, time_ms, moisture_res)"
+        " SELECT device, time_ms, moisture_res FROM moisture"
+        " ON DUPLICATE KEY UPDATE moisture_res = VALUES(moisture_res)",
+    ]),
+    (7, 'dryingfan absolute humidity and fan decision, fill by: python water/dryingfan.py backfill_derived', [
+        "ALTER TABLE dryingfan ADD COLUMN abs_out FLOAT NULL",
+        "ALTER TABLE dryingfan ADD COLUMN abs_in FLOAT NULL",
+        "ALTER TABLE dryingfan ADD COLUMN fan ENUM('Y','N') NULL",
+    ]),
+    (8, 'log id, pages of log are keyed by (time, id) as many lines may share one second', [
+        "ALTER TABLE log ADD COLUMN id INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY",
+    ]),
+    (9, 'index for retention of past forecasts', [
+        "CREATE INDEX forecast_to ON forecast (forecast_to)",
+    ]),
+]
+
+HOT_QUERIES = [  # (name, query) checked by explain, constants stand in for the real parameters
+    ('chart heights', "SELECT time, mm FROM height"
+                      " WHERE device = 'x' AND time BETWEEN 1600000000 AND 1600259200 ORDER BY time"),
+    ('chart rollup', "SELECT time, mm_sum / n, mm_last, last_time FROM height_hourly"
+                     " WHERE device = 'x' AND time BETWEEN 1600000000 AND 1607776000 ORDER BY time"),
+    ('chart overflow', "(SELECT opened, closed FROM overflow WHERE device = 'x'"
+                       "  AND opened BETWEEN 1600000000 AND 1600259200)"
+                       " UNION ALL"
+                       " (SELECT opened, closed FROM overflow WHERE device = 'x' AND opened < 1600000000"
+                       "  ORDER BY opened DESC LIMIT 1)"
+                       " ORDER BY opened"),
+    ('total overflow', "SELECT SUM(LEAST(closed, 1600259200) - GREATEST(opened, 1600000000)) FROM overflow"
+                       " WHERE device = 'x' AND closed >= 1600000000 AND opened <= 1600259200"),
+    ('log page', "SELECT time, id, msg FROM log WHERE device = 'x'"
+                 " AND (time < 1600000000 OR (time = 1600000000 AND id < 1000))"
+                 " ORDER BY time desc, id desc LIMIT 1000"),
+    ('pop command', "SELECT id, cmd FROM command WHERE popped = 'N' AND (device IS NULL OR device = 'x')"
+                    " ORDER BY id LIMIT 1"),
+    ('forecast index', "SELECT forecast_from, forecast_to, rain_mm FROM forecast"
+                       " WHERE valid_to >= 1600000000 ORDER BY forecast_from, valid_from"),
+    ('forecast retention', "SELECT valid_from FROM forecast WHERE forecast_to < 1600000000 LIMIT 500"),
+    ('environment range', "SELECT * FROM environment WHERE device = 'x' AND time_ms BETWEEN 1600000000 AND 1600259200"
+                          " ORDER BY time_ms"),
+]
+
+
+def current_version(cursor):
+    cursor.execute("CREATE TABLE IF NOT EXISTS schema_version"
+                   " (version INT NOT NULL, description VARCHAR(256), applied INT UNSIGNED, PRIMARY KEY (version))")
+    cursor.execute("SELECT MAX(version) FROM schema_version")
+    return cursor.fetchone()[0] or 0
+
+
+def migrate(db):
+    """apply migrations newer than the recorded version, each one is recorded when all its statements succeed"""
+    cursor = db.db.cursor()
+    version = current_version(cursor)
+    for (migration_version, description, statements) in MIGRATIONS:
+        if migration_version <= version:
+            continue
+        print("Migration %d: %s" % (migration_version, description))
+        for statement in statements:
+            try:
+                cursor.execute(statement)
+            except mysql.connector.Error as err:
+                if err.errno not in ALREADY_APPLIED:
+                    print("  FAILED: %s\n  %s" % (err.msg, statement))
+                    db.db.rollback()
+                    cursor.close()
+                    return False
+                print("  already applied: %s" % err.msg)
+        cursor.execute("INSERT INTO schema_version (version, description, applied) VALUES (%s, %s, %s)",
+                       (migration_version, description, int(time.time())))
+        db.db.commit()
+        print("  OK")
+    cursor.close()
+    print("Schema is at version %d" % MIGRATIONS[-1][0])
+    return True
+
+
+def status(db):
+    cursor = db.db.cursor()
+    version = current_version(cursor)
+    cursor.execute("SELECT version, description, applied FROM schema_version ORDER BY version")
+    for (applied_version, description, applied) in cursor:
+        print("%3d  %s  %s" % (applied_version, strtime(applied), description))
+    cursor.close()
+    for (migration_version, description, _) in MIGRATIONS:
+        if migration_version > version:
+            print("%3d  pending            %s" % (migration_version, description))
+
+
+def explain(db):
+    """print access path of each hot query, return False if some of them scans a whole table; rows reading
+       a temporary result, e.g. the UNION RESULT of a union, are not checked as there is no index to use;
+       note that the optimizer may prefer full scan of very small tables even when an index exists"""
+    ok = True
+    cursor = db.db.cursor(dictionary=True)
+    for (name, query) in HOT_QUERIES:
+        try:
+            cursor.execute("EXPLAIN " + query)
+            plans = cursor.fetchall()
+        except mysql.connector.Error as err:
+            print("%-18s  FAILED %s" % (name, err.msg))
+            ok = False
+            continue
+        for plan in plans:
+            if plan['table'] is None or plan['table'].startswith('<'):
+                continue  # <union1,2>, <derived2>: reads the result of the rows checked here
+            uses_index = plan['key'] is not None and plan['type'] != 'ALL'
+            ok = ok and uses_index
+            print("%-18s  %-4s  table %-14s key %-22s type %-6s rows %s" % (
+                name, 'OK' if uses_index else 'SCAN', plan['table'], plan['key'], plan['type'], plan['rows']))
+    cursor.close()
+    return ok
+
+
+def main():
+    import sys
+    db = JawsDB()
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'migrate':
+        sys.exit(0 if migrate(db) else 1)
+    if len(sys.argv) > 1 and sys.argv[1] == 'explain':
+        sys.exit(0 if explain(db) else 1)
+    status(db)
+
+
+if __name__ == "__main__":
+    from jawsdb import JawsDB, strtime
+    main()
+else:
+    from .jawsdb import JawsDB, strtime
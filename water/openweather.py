@@ -3,11 +3,18 @@ import logging
 import mysql.connector
 import os
 import requests
+import threading
 import time
 
 INTERVAL_S = 3*3600
-APPID = os.environ['OPENWEATHER_APPID']
-URL = "http://api.openweathermap.org/data/2.5/forecast?q=%s&mode=json&appid=%s"
+APPID = os.environ.get('OPENWEATHER_APPID', '')
+URL = os.environ.get('OPENWEATHER_URL', "http://api.openweathermap.org/data/2.5/forecast") + "?q=%s&mode=json&appid=%s"
+REFRESH_S = int(os.environ.get('FORECAST_REFRESH_S', 3*3600))  # 0 = refresh only when /forecast/update is called
+TIMEOUT_S = int(os.environ.get('FORECAST_TIMEOUT_S', 10))
+RETRIES = 3
+BACKOFF_S = 30  # doubled with every retry
+
+REFRESHER = None  # ForecastRefresher started by the server
 
 
 def handle_get(cfg, url, params, wfile):
@@ -19,48 +26,150 @@ def handle_get(cfg, url, params, wfile):
     if url.path.endswith('/html'):
         rsp += "<pre>\n" + read_forecast(db, time.time()) + "</pre>\n"
     if url.path.endswith('/update'):
-        insert_forecasts(db, get_forecast(cfg))
-        rsp += "UPDATE OK"
+        if REFRESHER is not None and REFRESHER.is_alive():
+            REFRESHER.trigger()
+            rsp += "UPDATE QUEUED"
+        elif insert_forecasts(db, get_forecast(cfg)):
+            rsp += "UPDATE OK"
+        else:
+            rsp += "UPDATE FAILED"
 
     if rsp == "":
         rsp = "UNKNOWN REQUEST"
 
+    db.close()
     wfile.write(bytes(rsp, 'utf-8'))
 
 
-def get_forecast(cfg):
-    """retrieve 5day/3hr forecasts, return list of tuples (timestamp of 3hr period start, precipitation forecast in mm)"""
+def get_forecast(cfg, timeout_s=TIMEOUT_S):
+    """retrieve 5day/3hr forecasts, return list of tuples (timestamp of 3hr period start, precipitation forecast in mm),
+       empty list if the service fails"""
     forecast = []
-    rsp = requests.get(URL % (cfg['city'], APPID))
+    try:
+        rsp = requests.get(URL % (cfg['city'], APPID), timeout=timeout_s)
+    except requests.RequestException as err:
+        logging.error('get_forecast failed: %s' % err)
+        return forecast
     if rsp.status_code == 200:
-        jsn = rsp.json()
-        if 'list' in jsn:
-            for pt in jsn['list']:
-                forecast.append((pt['dt'], pt['rain']['3h'] if ('rain' in pt and '3h' in pt['rain']) else 0.0))
+        try:
+            jsn = rsp.json()
+            for pt in jsn.get('list', []):
+                rain = pt.get('rain') or dict()
+                forecast.append((int(pt['dt']), float(rain.get('3h', 0.0))))
+        except (ValueError, TypeError, KeyError, AttributeError) as err:  # not JSON or not the expected shape
+            logging.error('get_forecast failed, unexpected response: %r' % err)
+            return []
+    else:
+        logging.error('get_forecast failed: HTTP %d' % rsp.status_code)
     return forecast
 
 
+class ForecastRefresher(threading.Thread):
+    """retrieves forecast every period_s seconds or when triggered, stores it only if it changed"""
+
+    def __init__(self, cfg, period_s):
+        threading.Thread.__init__(self, name='forecast')
+        self.daemon = True
+        self.cfg = cfg
+        self.period_s = period_s
+        self.wakeup = threading.Event()
+        self.last = dict(time=None, result='not run yet')
+
+    def trigger(self):
+        self.wakeup.set()
+
+    def run(self):
+        logging.info('forecast refresher running, period %ds' % self.period_s)
+        while True:
+            self.wakeup.wait(self.period_s if self.period_s > 0 else None)
+            self.wakeup.clear()
+            try:
+                self.refresh()
+            except Exception as err:  # the thread must survive, otherwise /forecast/update is queued for nobody
+                logging.exception('forecast refresh failed')
+                self.done('failed: %r' % err)
+
+    def refresh(self):
+        for attempt in range(RETRIES):
+            fcs = get_forecast(self.cfg)
+            if len(fcs) > 0:
+                break
+            if attempt < RETRIES - 1:
+                time.sleep(BACKOFF_S * 2**attempt)
+        else:
+            return self.done('retrieval failed')
+
+        with JawsDB() as db:
+            if db.db is None:
+                return self.done('no database connection')
+            if same_as_stored(db, fcs):
+                return self.done('unchanged, skipped')
+            return self.done('stored' if insert_forecasts(db, fcs) else 'insert failed')
+
+    def done(self, result):
+        logging.info('forecast refresh: %s' % result)
+        self.last = dict(time=strtime(time.time()), result=result)
+        return result
+
+
+def start_refresher(cfg):
+    global REFRESHER
+    REFRESHER = ForecastRefresher(cfg, REFRESH_S)
+    REFRESHER.start()
+    return REFRESHER
+
+
+def same_as_stored(db, fcs):
+    """True if the currently valid forecast has the same slots and precipitation as fcs"""
+    try:
+        cursor = db.db.cursor()
+        cursor.execute("SELECT forecast_from, rain_mm FROM forecast"
+                       " WHERE valid_to >= %d"
+                       "   AND forecast_from >= %d"
+                       " ORDER BY forecast_from"
+                       % (time.time(), min(fc[0] for fc in fcs)))
+        stored = cursor.fetchall()
+        cursor.close()
+    except mysql.connector.Error as err:
+        db.failed(err)
+        logging.error('same_as_stored failed: %s' % err.msg)
+        return False
+    # rain_mm is FLOAT, compare with tolerance
+    return len(stored) == len(fcs) \
+        and all(s[0] == f[0] and abs(s[1] - float(f[1])) < 0.005 for (s, f) in zip(stored, sorted(fcs)))
+
+
 def insert_forecasts(db, fcs):
-    """insert forecasts into database with current timestamp as valid-from, invalidate the old ones"""
+    """insert forecasts into database with current timestamp as valid-from, invalidate the old ones,
+       both in one transaction"""
+    if db.db is None or len(fcs) == 0:
+        return False
     now = time.time()
-    invalidate_old(db, fcs, now)
-    db.insert('forecast', 'valid_from, valid_to, forecast_from, forecast_to, rain_mm', '%s, %s, %s, %s, %s',
-              [(now, now + 1e9, fc[0], fc[0]+INTERVAL_S, fc[1]) for fc in fcs])
+    if not invalidate_old(db, fcs, now):
+        return False
+    if not db.insert('forecast', 'valid_from, valid_to, forecast_from, forecast_to, rain_mm', '%s, %s, %s, %s, %s',
+                     [(now, now + 1e9, fc[0], fc[0]+INTERVAL_S, fc[1]) for fc in fcs]):  # commits both
+        return False
+    forecastindex.load(db)
+    cache.invalidate()
+    return True
 
 
 def invalidate_old(db, fcs, now):
-    """invalidate forecasts that are replaced by fcs"""
+    """invalidate forecasts that are replaced by fcs with single UPDATE, not committed"""
     try:
-        for fc in fcs:
-            cursor = db.db.cursor()
-            query = ("UPDATE forecast SET valid_to = %d"
-                     " WHERE forecast_from = %d"
-                     "   AND valid_to >= %d"
-                     % (now-1, fc[0], now))
-            cursor.execute(query)
-            cursor.close()
+        cursor = db.db.cursor()
+        query = ("UPDATE forecast SET valid_to = %%s"
+                 " WHERE forecast_from IN (%s)"
+                 "   AND valid_to >= %%s"
+                 % ', '.join(['%s'] * len(fcs)))
+        cursor.execute(query, [int(now) - 1] + [fc[0] for fc in fcs] + [int(now)])
+        cursor.close()
+        return True
     except mysql.connector.Error as err:
-        rsp = err.msg
+        logging.error('invalidate_old failed: %s' % err.msg)
+        db.rollback(err)
+        return False
 
 
 def read_forecast(db, start_timestamp):
@@ -80,46 +189,50 @@ def read_forecast(db, start_timestamp):
                                                 rain_mm)
         cursor.close()
     except mysql.connector.Error as err:
+        db.failed(err)
         rsp = err.msg
     return rsp
 
 
 def rain_soon_mm(db, start_timestamp, end_timestamp):
-    rain_soon_mm = 0
-    try:
-        cursor = db.db.cursor()
-        query = ("SELECT SUM(rain_mm) FROM forecast"
-                 " WHERE valid_to >= %d"
-                 "   AND forecast_to >= %d"
-                 "   AND forecast_from <= %d"
-                 " ORDER BY forecast_from asc"
-                 % (time.time(), start_timestamp, end_timestamp))
-        cursor.execute(query)
-        for (rain_mm) in cursor:
-            rain_soon_mm = rain_mm
-            break
-        cursor.close()
-    except mysql.connector.Error as err:
-        return 0
-    return rain_soon_mm
+    """forecasted rain between the timestamps, slots partially inside count proportionally"""
+    return forecastindex.get(db).rain_between(start_timestamp, end_timestamp)
+
+
+def serve_stub(port):
+    """local stand-in for OpenWeatherMap returning 40 slots of forecast starting now, for testing refresh with
+       OPENWEATHER_URL=http://localhost:<port>/forecast"""
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    class StubHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            start = int(time.time()) // INTERVAL_S * INTERVAL_S
+            jsn = dict(list=[dict(dt=start + i*INTERVAL_S, rain={'3h': 0.5 * (i % 4)}) for i in range(40)])
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+            self.wfile.write(bytes(json.dumps(jsn), 'utf-8'))
+
+    print('serving stub forecast at http://localhost:%d/forecast' % port)
+    HTTPServer(('127.0.0.1', port), StubHandler).serve_forever()
 
 
 def main():
     """if this module is run, connect to the database and print it out + accept some command line arguments to test methods"""
     import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'stub':
+        serve_stub(int(sys.argv[2]) if len(sys.argv) >= 3 else 8001)
+        return
     db = JawsDB()
 
     if len(sys.argv) > 1:
+        if sys.argv[1] == 'refresh':
+            print(ForecastRefresher(dict(city=sys.argv[2] if len(sys.argv) >= 3 else 'pardubice,cz'), 0).refresh())
         if sys.argv[1] == 'insert':
             insert_forecasts(db, [(time.time(), sys.argv[2] if len(sys.argv) >= 3 else 1.23)])
         if sys.argv[1] == 'create_tables':
-            db.create("CREATE TABLE forecast ("
-                      " valid_from     INT UNSIGNED NOT NULL,"
-                      " valid_to       INT UNSIGNED NOT NULL,"
-                      " forecast_from  INT UNSIGNED NOT NULL,"
-                      " forecast_to    INT UNSIGNED NOT NULL,"
-                      " rain_mm        FLOAT,"
-                      "PRIMARY KEY (valid_from, forecast_from));")
+            print("tables and indexes are created by: python water/migrations.py migrate")
+            return
         if sys.argv[1] == 'delete':
             if len(sys.argv) == 3 and sys.argv[2] == 'really_do':
                 db.delete_all('forecast')
@@ -131,6 +244,8 @@ def main():
 
 if __name__ == "__main__":
     from jawsdb import JawsDB, strtime
+    import cache, forecastindex
     main()
 else:
     from .jawsdb import JawsDB, strtime
+    from . import cache, forecastindex
@@ -0,0 +1,87 @@
+"""recent readings kept in memory, charts and API read them instead of the database when the window is covered"""
+
+from array import array
+import bisect
+import os
+import threading
+
+SPAN_S = int(os.environ.get('RECENT_SPAN_S', 4*24*3600))  # default chart shows 3 days
+COMPACT_MIN = 1024  # drop expired items from the arrays once there is at least this many of them
+
+SERIES = dict()
+SERIES_LOCK = threading.Lock()
+WARMED = False  # all series with stored readings are warmed, a series seen later is covered from its first reading
+
+
+class RingBuffer:
+    """readings of the last span_s seconds in two parallel arrays of doubles sorted by time;
+       expired items at the start are skipped and dropped in batches"""
+
+    def __init__(self, span_s):
+        self.span_s = span_s
+        self.t = array('d')
+        self.y = array('d')
+        self.start = 0
+        self.covered_from = None  # all readings since this time are in the buffer, None until warmed
+        self.lock = threading.Lock()
+
+    def warm(self, rows, covered_from):
+        """fill with (time, value) rows sorted by time, which are all readings since covered_from"""
+        with self.lock:
+            self.t = array('d', [row[0] for row in rows])
+            self.y = array('d', [row[1] for row in rows])
+            self.start = 0
+            self.covered_from = covered_from
+
+    def append(self, tm, value):
+        with self.lock:
+            if self.covered_from is None and WARMED:
+                self.covered_from = tm  # new series, it had no readings when the others were warmed
+            if self.covered_from is None or tm < self.covered_from:
+                return  # not warmed yet or too old, the buffer must not have gaps
+            if len(self.t) == self.start or tm >= self.t[-1]:
+                self.t.append(tm)
+                self.y.append(value)
+            else:  # late reading, e.g. from device buffer
+                i = bisect.bisect_right(self.t, tm, self.start)
+                self.t.insert(i, tm)
+                self.y.insert(i, value)
+            self.expire(self.t[-1] - self.span_s)
+
+    def expire(self, cutoff):
+        if cutoff <= self.covered_from:
+            return
+        self.start = bisect.bisect_left(self.t, cutoff, self.start)
+        self.covered_from = cutoff
+        if self.start >= COMPACT_MIN and self.start > (len(self.t) - self.start):
+            del self.t[:self.start]
+            del self.y[:self.start]
+            self.start = 0
+
+    def read(self, tm_from, tm_to):
+        """list of (time, value) between tm_from and tm_to, None if the buffer does not cover tm_from"""
+        with self.lock:
+            if self.covered_from is None or tm_from < self.covered_from:
+                return None
+            i = bisect.bisect_left(self.t, tm_from, self.start)
+            j = bisect.bisect_right(self.t, tm_to, i)
+            return list(zip(self.t[i:j], self.y[i:j]))
+
+    def latest(self):
+        """time of the newest reading, None if not warmed, 0 if empty"""
+        with self.lock:
+            if self.covered_from is None:
+                return None
+            return self.t[-1] if len(self.t) > self.start else 0
+
+
+def mark_warmed():
+    global WARMED
+    WARMED = True
+
+
+def get(name):
+    with SERIES_LOCK:
+        if name not in SERIES:
+            SERIES[name] = RingBuffer(SPAN_S)
+        return SERIES[name]
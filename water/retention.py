@@ -0,0 +1,201 @@
+"""retention of old data: raw readings are kept RAW_DAYS, hourly aggregates and overflow intervals ROLLUP_DAYS,
+daily aggregates forever; old rows are deleted in chunks of CHUNK rows, each in its own short transaction, so that
+the live tables are never locked for long, and a table that lost a large part of its rows is rebuilt to give the
+space back (the free JawsDB plan has 5MB)
+
+    python water/retention.py        print policies, table sizes and rows to be deleted
+    python water/retention.py run    delete them now and print the report"""
+
+import logging
+import mysql.connector
+import os
+import threading
+import time
+
+DAY_S = 24*3600
+PERIOD_S = int(os.environ.get('RETENTION_PERIOD_S', DAY_S))  # 0 = no background job, run from command line only
+START_DELAY_S = 60  # first run after the server start, dynos are restarted daily so waiting a period may never run
+RAW_DAYS = int(os.environ.get('RETENTION_RAW_DAYS', 30))  # at least chart.RAW_MAX_S, longer charts read rollups
+ROLLUP_DAYS = int(os.environ.get('RETENTION_ROLLUP_DAYS', 400))  # at least chart.HOURLY_MAX_S
+CHUNK = int(os.environ.get('RETENTION_CHUNK', 500))  # rows per DELETE and transaction
+PAUSE_S = 0.1  # between chunks, lets inserts waiting for the locks through
+OPTIMIZE_FRACTION = float(os.environ.get('RETENTION_OPTIMIZE_FRACTION', 0.2))  # of rows deleted to rebuild, 0 = never
+
+POLICIES = [  # (table, time column, keep days, rows per device), height_daily and command are not listed
+    ('height', 'time', RAW_DAYS, True),
+    ('log', 'time', RAW_DAYS, True),
+    ('environment', 'time_ms', RAW_DAYS, True),
+    ('dryingfan', 'time_ms', RAW_DAYS, True),
+    ('temperature', 'time_ms', RAW_DAYS, True),  # narrow tables written before the environment table
+    ('humidity', 'time_ms', RAW_DAYS, True),
+    ('moisture', 'time_ms', RAW_DAYS, True),
+    ('forecast', 'forecast_to', RAW_DAYS, False),  # valid_to of the last version of a slot stays in the future
+    ('height_hourly', 'time', ROLLUP_DAYS, True),
+    ('overflow', 'closed', ROLLUP_DAYS, True),  # open interval has closed NULL and is never deleted
+]
+
+JOB = None  # RetentionJob started by the server
+
+
+class RetentionJob(threading.Thread):
+    """applies POLICIES every period_s seconds, keeps the report of the last run for the status page"""
+
+    def __init__(self, period_s):
+        threading.Thread.__init__(self, name='retention')
+        self.daemon = True
+        self.period_s = period_s
+        self.last = dict(time=None, result='not run yet', report=[])
+
+    def run(self):
+        logging.info('retention job running, period %ds' % self.period_s)
+        time.sleep(START_DELAY_S)
+        while True:
+            try:
+                self.apply()
+            except Exception as err:  # try again next period
+                logging.exception('retention failed')
+                self.done('failed: %r' % err, [])
+            time.sleep(self.period_s)
+
+    def apply(self):
+        with JawsDB() as db:
+            if db.db is None:
+                return self.done('no database connection', [])
+            report = apply_policies(db)
+            self.done('%d rows, ~%s' % (sum(r['rows'] for r in report), kb(sum(r['bytes'] for r in report))), report)
+
+    def done(self, result, report):
+        logging.info('retention: %s' % result)
+        self.last = dict(time=strtime(time.time()), result=result, report=report)
+
+
+def start_job():
+    global JOB
+    if PERIOD_S <= 0:
+        return None
+    JOB = RetentionJob(PERIOD_S)
+    JOB.start()
+    return JOB
+
+
+def apply_policies(db, tm_now=None):
+    """delete rows older than the policy of their table, return report [dict(table, rows, bytes, size_before,
+       size_after)], bytes is estimated from the average row length, the sizes (data and indexes) are measured"""
+    tm_now = tm_now if tm_now is not None else time.time()
+    sizes = table_sizes(db)
+    report = []
+    for (table, time_column, keep_days, per_device) in POLICIES:
+        if table not in sizes:
+            continue  # not created in this database
+        n_rows, avg_row_length, size_before = sizes[table]
+        deleted = delete_old(db, table, time_column, cutoff(tm_now, keep_days), per_device)
+        size_after = size_before
+        if deleted > 0 and 0 < OPTIMIZE_FRACTION * max(n_rows, 1) <= deleted:
+            size_after = optimize(db, table)
+        report.append(dict(table=table, rows=deleted, bytes=deleted * avg_row_length,
+                           size_before=size_before, size_after=size_after))
+    return report
+
+
+def cutoff(tm_now, keep_days):
+    """start of the day keep_days ago, so that whole daily buckets are deleted and backfill_rollups of the rest
+       does not recompute a bucket from a part of its rows"""
+    return (int(tm_now) - keep_days * DAY_S) // DAY_S * DAY_S
+
+
+def delete_old(db, table, time_column, tm_cutoff, per_device):
+    """delete rows with time_column before tm_cutoff, CHUNK rows per transaction, return number of deleted rows;
+       tables keyed by device are deleted per device, so that every chunk is a range of the (device, time) key"""
+    deleted = 0
+    try:
+        cursor = db.db.cursor()
+        if per_device:
+            cursor.execute("SELECT DISTINCT device FROM %s" % table)
+            ranges = [("DELETE FROM %s WHERE device = %%s AND %s < %%s LIMIT %%s" % (table, time_column),
+                       (device, tm_cutoff, CHUNK)) for (device,) in cursor.fetchall()]
+        else:
+            ranges = [("DELETE FROM %s WHERE %s < %%s LIMIT %%s" % (table, time_column), (tm_cutoff, CHUNK))]
+        for (statement, args) in ranges:
+            while True:
+                cursor.execute(statement, args)
+                db.db.commit()
+                deleted += cursor.rowcount
+                if cursor.rowcount < CHUNK:
+                    break
+                time.sleep(PAUSE_S)
+        cursor.close()
+    except mysql.connector.Error as err:
+        logging.error('retention of %s failed after %d rows: %s' % (table, deleted, err.msg))
+        db.rollback(err)
+    return deleted
+
+
+def optimize(db, table):
+    """rebuild the table to return the space of deleted rows, return its size afterwards"""
+    try:
+        cursor = db.db.cursor()
+        cursor.execute("OPTIMIZE TABLE %s" % table)
+        cursor.fetchall()
+        cursor.close()
+        logging.info('retention rebuilt %s' % table)
+    except mysql.connector.Error as err:
+        db.failed(err)
+        logging.error('retention could not rebuild %s: %s' % (table, err.msg))
+    sizes = table_sizes(db)
+    return sizes[table][2] if table in sizes else None
+
+
+def table_sizes(db):
+    """{table: (estimated rows, average row length, data and index bytes)} of the current database"""
+    try:
+        cursor = db.db.cursor()
+        cursor.execute("SELECT TABLE_NAME, TABLE_ROWS, AVG_ROW_LENGTH, DATA_LENGTH + INDEX_LENGTH"
+                       "  FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE()")
+        sizes = dict((name.lower(), (int(rows or 0), int(avg or 0), int(size or 0)))
+                     for (name, rows, avg, size) in cursor)
+        cursor.close()
+        return sizes
+    except mysql.connector.Error as err:
+        db.failed(err)
+        logging.error('table sizes not read: %s' % err.msg)
+        return dict()
+
+
+def kb(n_bytes):
+    return '%.1fkB' % (n_bytes / 1024.0) if n_bytes is not None else 'n/a'
+
+
+def report_lines(report):
+    return '\n'.join('%-14s %7d rows  ~%9s  size %9s -> %9s' % (
+        r['table'], r['rows'], kb(r['bytes']), kb(r['size_before']), kb(r['size_after'])) for r in report)
+
+
+def count_old(db, tm_now):
+    """print policies with table sizes and rows older than them, deletes nothing"""
+    sizes = table_sizes(db)
+    cursor = db.db.cursor()
+    for (table, time_column, keep_days, _) in POLICIES:
+        if table not in sizes:
+            continue
+        cursor.execute("SELECT COUNT(*) FROM %s WHERE %s < %%s" % (table, time_column), (cutoff(tm_now, keep_days),))
+        (n_old,) = cursor.fetchone()
+        print('%-14s keep %4d days  %7d rows  size %9s  %7d rows to delete'
+              % (table, keep_days, sizes[table][0], kb(sizes[table][2]), n_old))
+    cursor.close()
+
+
+def main():
+    import sys
+    db = JawsDB()
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'run':
+        print(report_lines(apply_policies(db)))
+        return
+    count_old(db, time.time())
+
+
+if __name__ == "__main__":
+    from jawsdb import JawsDB, strtime
+    main()
+else:
+    from .jawsdb import JawsDB, strtime
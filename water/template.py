@@ -0,0 +1,63 @@
+"""HTML page templates with %PLACEHOLDER% fields, parsed once and rendered in a single pass"""
+
+import os
+import re
+import threading
+
+PLACEHOLDER = re.compile(r'%([A-Z_]+)%')
+RELOAD = os.environ.get('TEMPLATE_RELOAD', '0') == '1'  # re-read changed template files, for development
+
+TEMPLATES = dict()
+TEMPLATES_LOCK = threading.Lock()
+
+
+class Template:
+    """template compiled to alternating segments: literal bytes, placeholder name, literal bytes, ..."""
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.segments = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        with open(self.path, 'r') as template_file:
+            text = template_file.read()
+            mtime = os.fstat(template_file.fileno()).st_mtime
+        parts = PLACEHOLDER.split(text)  # odd items are the placeholder names
+        self.segments = [bytes(part, 'utf-8') if i % 2 == 0 else part for i, part in enumerate(parts)]
+        self.mtime = mtime
+
+    def compiled(self):
+        with self.lock:
+            if self.segments is None or (RELOAD and os.stat(self.path).st_mtime != self.mtime):
+                self.load()
+            return self.segments
+
+    def render(self, wfile, values):
+        """write the page to wfile piece by piece"""
+        for chunk in self.chunks(values):
+            wfile.write(chunk)
+
+    def chunks(self, values):
+        """generate the page as bytes pieces, placeholders without value are left in place"""
+        for i, segment in enumerate(self.compiled()):
+            if i % 2 == 0:
+                yield segment
+            elif segment in values:
+                yield bytes(values[segment], 'utf-8')
+            else:
+                yield bytes('%' + segment + '%', 'utf-8')
+
+
+def get(path):
+    with TEMPLATES_LOCK:
+        if path not in TEMPLATES:
+            TEMPLATES[path] = Template(path)
+        return TEMPLATES[path]
+
+
+def preload(*paths):
+    """parse templates at startup so that the first request does not pay for it"""
+    for path in paths:
+        get(path).compiled()
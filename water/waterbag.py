@@ -1,120 +1,406 @@
 import logging
 import math
 import mysql.connector
+import os
+import threading
 import time
+from array import array
 
 from builtins import float, int, abs, bytes, pow, len
 
+DAY_S = 24*3600
+ROLLUPS = (('height_hourly', 3600), ('height_daily', DAY_S))  # (table, bucket length in seconds), UTC buckets
+COMMAND_WAIT_MAX_S = 25  # long poll limit, Heroku router times out requests after 30s
+COMMAND_QUEUED = threading.Condition()  # notified by insert_command of this process, e.g. from the config page
+COMMAND_GENERATION = 0  # incremented with every queued command
+COMMAND_WAITERS_MAX = int(os.environ.get('COMMAND_WAITERS_MAX', 2))  # each waiting request holds a server thread
+COMMAND_WAITERS = 0  # requests waiting now, more than COMMAND_WAITERS_MAX are answered at once
+COMMAND_KEEP_S = 30*DAY_S  # delivered commands are deleted after this time
+COMMAND_EXPIRE_BATCH = 100
+OVERFLOW_OPENED = 'overflow_opened:'  # log messages sent by waterbag.ino
+OVERFLOW_CLOSED = 'overflow_closed:'
+ROLLUP_UPSERT = ("INSERT INTO %s (device, time, mm_min, mm_max, mm_sum, n, mm_last, last_time)"
+                 " VALUES (%%s, %%s, %%s, %%s, %%s, 1, %%s, %%s)"
+                 " ON DUPLICATE KEY UPDATE"
+                 "  mm_min = LEAST(mm_min, VALUES(mm_min)),"
+                 "  mm_max = GREATEST(mm_max, VALUES(mm_max)),"
+                 "  mm_sum = mm_sum + VALUES(mm_sum),"
+                 "  n = n + 1,"
+                 "  mm_last = IF(VALUES(last_time) >= last_time, VALUES(mm_last), mm_last),"  # before last_time changes
+                 "  last_time = GREATEST(last_time, VALUES(last_time))")
+ROLLUP_BACKFILL = ("REPLACE INTO %s (device, time, mm_min, mm_max, mm_sum, n, mm_last, last_time)"
+                   " SELECT device, time DIV %d * %d, MIN(mm), MAX(mm), SUM(mm), COUNT(*),"
+                   "        CAST(SUBSTRING_INDEX(GROUP_CONCAT(mm ORDER BY time DESC), ',', 1) AS SIGNED), MAX(time)"
+                   "   FROM height"
+                   "  GROUP BY device, time DIV %d")
+
 
 def handle_get(cfg, url, params, wfile):
-    db = JawsDB()
+    db = None
     rsp = ""
 
     logging.info('waterbag.handle_get urlparse:%s; parse_qs: %s' % (url, params))
+    device = device_param(params)
     if 'insert_mm' in params:
         height_mm = int(params['insert_mm'][0])
-        logging.info('insert %dmm height into db' % height_mm)
-        insert_height(db, height_mm)
-        logging.info('done')
-        check_forecast(cfg, db, height_mm)
+        if ingest.QUEUE is not None:
+            ingest.QUEUE.submit(device, time.time(), params)  # stored and checked against forecast in background
+        else:
+            logging.info('insert %dmm height of %s into db' % (height_mm, device))
+            db = JawsDB()
+            insert_height(db, device, height_mm)
+            logging.info('done')
+            check_forecast(cfg, db, height_mm)
         rsp += 'OK'
 
     elif 'insert_log' in params:
         msg = params['insert_log'][0]
-        logging.info('insert log into db: %s' % msg)
-        insert_log(db, msg)
-        logging.info('done')
+        if ingest.QUEUE is not None:
+            ingest.QUEUE.submit(device, time.time(), params)
+        else:
+            logging.info('insert log of %s into db: %s' % (device, msg))
+            db = JawsDB()
+            insert_log(db, device, msg)
+            logging.info('done')
         rsp += 'OK'
 
     elif url.path.endswith('log'):
-        rsp += "<pre>" + read_log(db) + "</pre>\n"
+        before, limit = page_params(params)
+        before_id = int(params['before_id'][0]) if 'before_id' in params else None
+        db = JawsDB()
+        stream_pre(wfile, read_log(db, device, before, limit,
+                                   'log?device=' + device + '&before=%d&before_id=%d&limit=%d', before_id))
+        db.close()
+        return
 
     elif url.path.endswith('command'):
-        rsp += pop_command(db)
+        wait_s = min(int(params['wait'][0]), COMMAND_WAIT_MAX_S) if 'wait' in params else 0
+        deadline = time.time() + wait_s
+        generation = COMMAND_GENERATION
+        db = JawsDB()
+        rsp += pop_command(db, device)
+        if rsp == "" and wait_s > 0 and enter_wait():
+            db.close()  # do not hold pooled connection while waiting
+            try:
+                while rsp == "" and wait_for_command(generation, deadline - time.time()):
+                    generation = COMMAND_GENERATION  # command may be for other device, then wait again
+                    db = JawsDB()
+                    rsp += pop_command(db, device)
+                    db.close()
+            finally:
+                leave_wait()
 
     else:
-        rsp += "<pre>" + read_height(db, 30) + "</pre>\n"
+        before, limit = page_params(params)
+        next_href = 'waterbag?device=' + device + '&before=%d&limit=%d'
+        db = JawsDB()
+        stream_pre(wfile, read_height(db, device, 30, before, limit, next_href))
+        db.close()
+        return
 
     if rsp == "":
         rsp = "UNKNOWN REQUEST"
 
+    if db is not None:
+        db.close()
     wfile.write(bytes(rsp, 'utf-8'))
 
 
-def insert_height(db, height_mm):
-    db.insert('height', 'time, mm', '%s, %s', (time.time(), height_mm))
+def insert_height(db, device, height_mm):
+    """insert height and update hourly and daily rollups in the same transaction"""
+    tm = int(time.time())
+    if db.insert('height', 'device, time, mm', '%s, %s, %s', (device, tm, height_mm), commit=False):
+        if update_rollups(db, device, [(tm, height_mm)]):
+            recent.get(recent_series(device)).append(tm, height_mm)
+            cache.invalidate()
 
 
-def insert_log(db, msg):
-    db.insert('log', 'time, msg', '%s, %s', (time.time(), msg))
+def recent_series(device):
+    return 'height/' + device
 
 
-def insert_command(db, cmd):
-    return db.insert('command', 'time, cmd, popped', '%s, %s, %s', (time.time(), cmd, 'N'))
+def warm_recent(db):
+    """load heights of last recent.SPAN_S seconds into memory, call before the server accepts inserts"""
+    covered_from = int(time.time()) - recent.SPAN_S
+    if db.db is None:
+        logging.error('warm_recent skipped, charts will read heights from database')
+        return
+    try:
+        cursor = db.db.cursor()
+        cursor.execute("SELECT DISTINCT device FROM height")  # short index scan of the primary key prefix
+        devices = [device for (device,) in cursor.fetchall()]
+        for device in devices:
+            cursor.execute("SELECT time, mm FROM height WHERE device = %s AND time >= %s ORDER BY time",
+                           (device, covered_from))
+            rows = cursor.fetchall()
+            recent.get(recent_series(device)).warm(rows, covered_from)
+            logging.info('%d recent heights of %s loaded' % (len(rows), device))
+        cursor.close()
+        recent.mark_warmed()  # devices sending their first reading later start with empty buffers
+    except mysql.connector.Error as err:
+        db.failed(err)
+        logging.error('warm_recent failed, charts will read heights from database: %s' % err.msg)
 
 
-def read_height(db, days):
-    """return list of heights in pre-tags, history for given number of days"""
-    rsp = ""
+def update_rollups(db, device, rows):
+    """add (time, mm) rows of device to min/max/sum/last aggregates of their hour and day, commit"""
+    try:
+        cursor = db.db.cursor()
+        for (table, bucket_s) in ROLLUPS:
+            cursor.executemany(ROLLUP_UPSERT % table,
+                               [(device, tm // bucket_s * bucket_s, mm, mm, mm, mm, tm) for (tm, mm) in rows])
+        cursor.close()
+        db.db.commit()
+        return True
+    except mysql.connector.Error as err:
+        logging.error('update_rollups failed: %s' % err.msg)
+        db.rollback(err)
+        return False
+
+
+def backfill_rollups(db):
+    """recompute rollup tables from all rows in height"""
+    try:
+        cursor = db.db.cursor()
+        for (table, bucket_s) in ROLLUPS:
+            print("Backfilling %s" % table)
+            cursor.execute(ROLLUP_BACKFILL % (table, bucket_s, bucket_s, bucket_s))
+            print("  %d rows" % cursor.rowcount)
+        cursor.close()
+        db.db.commit()
+    except mysql.connector.Error as err:
+        print("  " + err.msg)
+        db.rollback(err)
+
+
+def insert_log(db, device, msg):
+    tm = int(time.time())
+    if db.insert('log', 'device, time, msg', '%s, %s, %s', (device, tm, msg)) and msg.startswith('overflow_'):
+        record_overflow(db, device, tm, msg)
+        cache.invalidate()  # overflow is shown in the chart
+
+
+def record_overflow(db, device, tm, msg):
+    """keep overflow table of valve open intervals in sync with overflow_opened:/overflow_closed: log messages"""
     try:
         cursor = db.db.cursor()
-        query = "SELECT time, mm FROM height WHERE time >= %d ORDER BY time desc" % (time.time() - days*24*3600)
-        cursor.execute(query)
+        apply_overflow_msg(cursor, device, tm, msg)
+        cursor.close()
+        db.db.commit()
+    except mysql.connector.Error as err:
+        logging.error('record_overflow failed: %s' % err.msg)
+        db.rollback(err)
+
+
+def apply_overflow_msg(cursor, device, tm, msg):
+    """opening starts new interval unless one is open already (e.g. device restarted while opened),
+       closing ends the open interval, closing without opening is ignored"""
+    if msg.startswith(OVERFLOW_OPENED):
+        cursor.execute("SELECT COUNT(*) FROM overflow WHERE device = %s AND closed IS NULL", (device,))
+        if cursor.fetchone()[0] == 0:
+            cursor.execute("INSERT INTO overflow (device, opened) VALUES (%s, %s)", (device, tm))
+    elif msg.startswith(OVERFLOW_CLOSED):
+        cursor.execute("UPDATE overflow SET closed = %s, duration_s = %s - opened"
+                       " WHERE device = %s AND closed IS NULL AND opened <= %s ORDER BY opened DESC LIMIT 1",
+                       (tm, tm, device, tm))
+
+
+def backfill_overflow(db):
+    """rebuild overflow table from overflow messages in log; intervals opened before the oldest log line of their
+       device are kept, the log of that time may have been deleted by retention"""
+    try:
+        cursor = db.db.cursor()
+        cursor.execute("SELECT device, time, msg FROM log WHERE msg LIKE 'overflow_%' ORDER BY device, time, id")
+        messages = cursor.fetchall()
+        cursor.execute("SELECT device, MIN(time) FROM log GROUP BY device")
+        for (device, oldest) in cursor.fetchall():
+            cursor.execute("DELETE FROM overflow WHERE device = %s AND opened >= %s", (device, oldest))
+        for (device, tm, msg) in messages:
+            apply_overflow_msg(cursor, device, tm, msg)
+        cursor.close()
+        db.db.commit()
+        print("%d overflow messages processed" % len(messages))
+    except mysql.connector.Error as err:
+        print("  " + err.msg)
+        db.rollback(err)
+
+
+def read_overflow_intervals(cursor, device, tm_from, tm_to):
+    """list of (opened, closed or None) overlapping the window: those opened within it and the last one opened
+       before it (intervals of one device do not overlap, so no earlier one can reach into the window)"""
+    cursor.execute("(SELECT opened, closed FROM overflow WHERE device = %s AND opened BETWEEN %s AND %s)"
+                   " UNION ALL"
+                   " (SELECT opened, closed FROM overflow WHERE device = %s AND opened < %s"
+                   "  ORDER BY opened DESC LIMIT 1)"
+                   " ORDER BY opened",
+                   (device, int(tm_from), int(tm_to), device, int(tm_from)))
+    return [(opened, closed) for (opened, closed) in cursor
+            if opened >= tm_from or closed is None or closed >= tm_from]
+
+
+def total_overflow_s(cursor, device, tm_from, tm_to):
+    """seconds the valve was open between tm_from and tm_to, intervals still open are not counted"""
+    cursor.execute("SELECT COALESCE(SUM(LEAST(closed, %s) - GREATEST(opened, %s)), 0) FROM overflow"
+                   " WHERE device = %s AND closed >= %s AND opened <= %s",
+                   (int(tm_to), int(tm_from), device, int(tm_from), int(tm_to)))
+    return int(cursor.fetchone()[0])
+
+
+def insert_command(db, cmd, device=None):
+    """queue command for given device, None means whichever device asks first"""
+    if not db.insert('command', 'time, cmd, popped, device', '%s, %s, %s, %s', (time.time(), cmd, 'N', device)):
+        return False
+    notify_command()
+    return True
+
+
+def notify_command():
+    """wake up requests waiting for a command"""
+    global COMMAND_GENERATION
+    with COMMAND_QUEUED:
+        COMMAND_GENERATION += 1
+        COMMAND_QUEUED.notify_all()
+
+
+def enter_wait():
+    """take one of COMMAND_WAITERS_MAX waiting slots, False if all are taken"""
+    global COMMAND_WAITERS
+    with COMMAND_QUEUED:
+        if COMMAND_WAITERS >= COMMAND_WAITERS_MAX:
+            logging.info('%d requests wait for a command already, answering at once' % COMMAND_WAITERS)
+            return False
+        COMMAND_WAITERS += 1
+        return True
+
+
+def leave_wait():
+    global COMMAND_WAITERS
+    with COMMAND_QUEUED:
+        COMMAND_WAITERS -= 1
+
+
+def wait_for_command(generation, timeout_s):
+    """block until a command is queued after COMMAND_GENERATION was read as generation, False on timeout"""
+    deadline = time.time() + timeout_s
+    with COMMAND_QUEUED:
+        while COMMAND_GENERATION == generation:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            COMMAND_QUEUED.wait(remaining)
+        return True
+
+
+def read_height(db, device, days, before=None, limit=None, next_href=None):
+    """generate lines of heights newer than given number of days and older than before, repeated heights
+       are counted instead of listed, ends with link to next page if next_href is given"""
+    limit = limit if limit is not None else PAGE_LIMIT
+    cursor = None
+    try:
+        cursor = db.db.cursor()
+        cursor.execute("SELECT time, mm FROM height WHERE device = %s AND time >= %s AND time < %s"
+                       " ORDER BY time desc LIMIT %s",
+                       (device, int(time.time()) - days*24*3600, before if before is not None else 2**32, limit))
         last = -1
         repeated = 0
+        n_rows, last_ts = 0, None
         for (timestamp, mm) in cursor:
             if abs(mm-last) > 0:
                 if repeated > 1:
-                    rsp += "  (%dx)" % repeated
-                rsp += "\n%s  %dmm" % (time.strftime("%a %d.%m. %X", time.localtime(timestamp)), mm)
+                    yield "  (%dx)" % repeated
+                yield "\n%s  %dmm" % (time.strftime("%a %d.%m. %X", time.localtime(timestamp)), mm)
                 last = mm
                 repeated = 1
             else:
                 repeated += 1
-        cursor.close()
+            n_rows, last_ts = n_rows + 1, timestamp
+        if repeated > 1:
+            yield "  (%dx)" % repeated
+        yield next_page_link(next_href, last_ts, n_rows, limit)
     except mysql.connector.Error as err:
-        rsp = err.msg
-    return rsp
+        db.failed(err)
+        yield err.msg
+    finally:
+        if cursor is not None:
+            cursor.close()
 
 
-def read_log(db):
-    """return list of heights in pre-tags"""
-    rsp = ""
+def read_log(db, device, before=None, limit=None, next_href=None, before_id=None):
+    """generate log lines before the (before, before_id) key, newest first, ends with link to next page if next_href
+       is given; lines of one second are ordered by id, without before_id all lines of second before are skipped"""
+    limit = limit if limit is not None else PAGE_LIMIT
+    before = before if before is not None else 2**32
+    cursor = None
     try:
         cursor = db.db.cursor()
-        query = ("SELECT time, msg FROM log ORDER BY time desc")
-        cursor.execute(query)
-        for (timestamp, msg) in cursor:
-            rsp += "\n%s  %s" % (time.strftime("%a %d.%m. %X", time.localtime(timestamp)), msg)
-        cursor.close()
+        cursor.execute("SELECT time, id, msg FROM log"
+                       " WHERE device = %s AND (time < %s OR (time = %s AND id < %s))"
+                       " ORDER BY time desc, id desc LIMIT %s",
+                       (device, before, before, before_id if before_id is not None else 0, limit))
+        n_rows, last_key = 0, None
+        for (timestamp, log_id, msg) in cursor:
+            yield "\n%s  %s" % (time.strftime("%a %d.%m. %X", time.localtime(timestamp)), msg)
+            n_rows, last_key = n_rows + 1, (timestamp, log_id)
+        yield next_page_link(next_href, last_key, n_rows, limit)
     except mysql.connector.Error as err:
-        rsp = err.msg
-    return rsp
+        db.failed(err)
+        yield err.msg
+    finally:
+        if cursor is not None:
+            cursor.close()
 
 
-def pop_command(db):
+def pop_command(db, device):
+    """claim the oldest undelivered command for the device (or for any device) and mark it delivered to this
+       device in one transaction: SELECT ... FOR UPDATE makes concurrent pollers wait for the row, the conditional
+       UPDATE guarantees that only one of them gets it"""
     rsp = ""
     try:
         cursor = db.db.cursor()
-        query = "SELECT time, cmd FROM command WHERE popped='N' ORDER BY time asc LIMIT 1"
-        cursor.execute(query)
-
-        for (timestamp, cmd) in cursor:
-            rsp += cmd
-            cursor.close()
-            cursor2 = db.db.cursor()
-            update = ("UPDATE command SET popped = 'Y' WHERE time = %d AND cmd = '%s' AND popped = 'N'"
-                     % (timestamp, cmd))
-            cursor2.execute(update)
-            cursor2.close()
+        for attempt in range(3):  # retry if another poller claimed the row first
+            cursor.execute("SELECT id, cmd FROM command"
+                           " WHERE popped = 'N' AND (device IS NULL OR device = %s)"
+                           " ORDER BY id LIMIT 1 FOR UPDATE", (device,))
+            row = cursor.fetchone()
+            if row is None:
+                break
+            cursor.execute("UPDATE command SET popped = 'Y', delivered = %s, device = %s"
+                           " WHERE id = %s AND popped = 'N'",
+                           (int(time.time()), device, row[0]))
+            claimed = cursor.rowcount == 1
             db.db.commit()
-            break  # only one command will be sent, client will ask for next one when ready
-
+            if claimed:
+                rsp = row[1]
+                break  # only one command will be sent, client will ask for next one when ready
+        cursor.close()
     except mysql.connector.Error as err:
-        rsp = err.msg
+        db.rollback(err)
+        return err.msg
+
+    if rsp != "":
+        expire_commands(db)
     return rsp
 
 
+def expire_commands(db):
+    """delete (in small batch) commands delivered more than COMMAND_KEEP_S ago, except the latest delivered
+       config of each device which is shown as its current config"""
+    try:
+        cursor = db.db.cursor()
+        cursor.execute("DELETE FROM command"
+                       " WHERE popped = 'Y'"
+                       "   AND COALESCE(delivered, time) < %s"
+                       "   AND id NOT IN (SELECT id FROM (SELECT MAX(id) AS id FROM command"
+                       "                                   WHERE popped = 'Y' AND cmd LIKE '{%%'"
+                       "                                   GROUP BY device) latest)"
+                       " LIMIT %s", (int(time.time()) - COMMAND_KEEP_S, COMMAND_EXPIRE_BATCH))
+        cursor.close()
+        db.db.commit()
+    except mysql.connector.Error as err:
+        logging.error('expire_commands failed: %s' % err.msg)
+        db.rollback(err)
+
+
 def waterbag_cut_mm2(height_mm, flat_width_mm):
     """approximate area of waterbag cut: assume constant circumference (2*flat_width)
     and shape of half-circle at either side (total one circle with r=height_mm/2 with rectangle between them"""
@@ -122,17 +408,68 @@ def waterbag_cut_mm2(height_mm, flat_width_mm):
     return math.pi * pow(r_mm, 2) + height_mm * (flat_width_mm - math.pi * r_mm)
 
 
+class VolumeModel:
+    """height to volume conversion for one configuration, litres for every whole mm up to twice the maximum
+       height are precomputed, fractions are interpolated, heights out of the table are computed directly"""
+
+    def __init__(self, method, max_height_mm, max_volume_l, flat_width_mm):
+        self.key = (method, max_height_mm, max_volume_l, flat_width_mm)
+        self.method = method
+        self.max_height_mm = float(max_height_mm)
+        self.max_volume_l = float(max_volume_l)
+        self.flat_width_mm = float(flat_width_mm)
+        if method == 'oval':
+            self.max_cut_mm2 = waterbag_cut_mm2(self.max_height_mm, self.flat_width_mm)
+        self.table = array('d', [self.compute(mm) for mm in range(int(2 * self.max_height_mm) + 2)])
+
+    def compute(self, height_mm):
+        """linear approximation will work for tanks with constant horizontal area
+           oval is approximation for bag which gets rounder with increasing height"""
+        if self.method == 'linear':
+            return height_mm * self.max_volume_l / self.max_height_mm
+        elif self.method == 'oval':
+            return waterbag_cut_mm2(height_mm, self.flat_width_mm) * self.max_volume_l / self.max_cut_mm2
+        return -1
+
+    def volume_l(self, height_mm):
+        i = int(height_mm)
+        if 0 <= i < len(self.table) - 1:
+            return self.table[i] + (height_mm - i) * (self.table[i+1] - self.table[i])
+        return self.compute(height_mm)
+
+    def volumes_l(self, heights_mm):
+        """convert whole series, same as volume_l for each item"""
+        table, last = self.table, len(self.table) - 1
+        volumes = []
+        for height_mm in heights_mm:
+            i = int(height_mm)
+            if 0 <= i < last:
+                volumes.append(table[i] + (height_mm - i) * (table[i+1] - table[i]))
+            else:
+                volumes.append(self.compute(height_mm))
+        return volumes
+
+
+VOLUME_MODEL = None
+
+
+def volume_model(cfg):
+    """model for current config, rebuilt when any of the parameters it depends on changes"""
+    global VOLUME_MODEL
+    key = (cfg['volume_method'], cfg['max_height_mm'], cfg['max_volume_l'], cfg['flat_width_mm'])
+    model = VOLUME_MODEL
+    if model is None or model.key != key:
+        model = VolumeModel(*key)
+        VOLUME_MODEL = model
+    return model
+
+
 def volume_l(cfg, height_mm):
-    """linear approximation will work for tanks with constant horizontal area
-       oval is approximation for bag which gets rounder with increasing height
-       :param cfg: """
-    if cfg['volume_method'] == 'linear':
-        return height_mm * float(cfg['max_volume_l']) / float(cfg['max_height_mm'])
-    elif cfg['volume_method'] == 'oval':
-        return waterbag_cut_mm2(height_mm, float(cfg['flat_width_mm'])) \
-               * float(cfg['max_volume_l']) \
-               / waterbag_cut_mm2(float(cfg['max_height_mm']), float(cfg['flat_width_mm']))
-    return -1
+    return volume_model(cfg).volume_l(height_mm)
+
+
+def volumes_l(cfg, heights_mm):
+    return volume_model(cfg).volumes_l(heights_mm)
 
 
 def rain_l(cfg, rain_mm):
@@ -140,8 +477,6 @@ def rain_l(cfg, rain_mm):
     return rain_mm * float(cfg['roof_area_m2'])
 
 
-from .openweather import rain_soon_mm
-
 def check_forecast(cfg, db, height_mm):
     """check whether waterbag can discharge the rain coming in next interval"""
 
@@ -149,7 +484,8 @@ def check_forecast(cfg, db, height_mm):
     bag_l_per_mm = float(cfg['max_volume_l']) / float(cfg['max_height_mm'])
 
     # get forecast for the time interval until next forced height measurement
-    forecast_mm = rain_soon_mm(db, time.time(), time.time() + cfg['FORCE_SEND_S'])  # TODO sensor params are in DB!
+    force_send_s = int(cfg.get('FORCE_SEND_S', 7200))  # TODO sensor params are in DB!
+    forecast_mm = rain_soon_mm(db, time.time(), time.time() + force_send_s)
     rain_soon_bag_mm = rain_l(cfg, forecast_mm) / bag_l_per_mm
 
     # calculate how much can be discharged in terms of waterbag height in next 30 minutes
@@ -157,7 +493,7 @@ def check_forecast(cfg, db, height_mm):
     can_discharge_soon_bag_mm = can_discharge_soon_bag_l / bag_l_per_mm
 
     logging.info('check_forecast %d + %d > %d + %d' %
-                 height_mm, rain_soon_bag_mm, float(cfg['max_height_mm']), can_discharge_soon_bag_mm)
+                 (height_mm, rain_soon_bag_mm, float(cfg['max_height_mm']), can_discharge_soon_bag_mm))
 
     if (height_mm + rain_soon_bag_mm) > (float(cfg['max_height_mm']) + can_discharge_soon_bag_mm):
         logging.warn('TODO temporarily decrease trigger overflow height')
@@ -171,23 +507,28 @@ def main():
 
     if len(sys.argv) > 1:
         if sys.argv[1] == 'insert_height':
-            insert_height(db, int(sys.argv[2]) if len(sys.argv) >= 3 else 123)
+            insert_height(db, DEFAULT_DEVICE, int(sys.argv[2]) if len(sys.argv) >= 3 else 123)
         if sys.argv[1] == 'read_log':
-            print(read_log(db))
+            print(''.join(read_log(db, sys.argv[2] if len(sys.argv) >= 3 else DEFAULT_DEVICE)))
             return
         if sys.argv[1] == 'insert_log':
-            insert_log(db, sys.argv[2] if len(sys.argv) >= 3 else "testing message")
+            insert_log(db, DEFAULT_DEVICE, sys.argv[2] if len(sys.argv) >= 3 else "testing message")
             return
         if sys.argv[1] == 'pop_command':
-            print(pop_command(db))
+            print(pop_command(db, sys.argv[2] if len(sys.argv) >= 3 else DEFAULT_DEVICE))
             return
         if sys.argv[1] == 'insert_command':
-            insert_command(db, sys.argv[2] if len(sys.argv) >= 3 else "testing command")
+            insert_command(db, sys.argv[2] if len(sys.argv) >= 3 else "testing command",
+                           sys.argv[3] if len(sys.argv) >= 4 else None)
             return
         if sys.argv[1] == 'create_tables':
-            db.create("CREATE TABLE height (time INT UNSIGNED NOT NULL, mm INT, PRIMARY KEY (time));")
-            db.create("CREATE TABLE log (time INT UNSIGNED NOT NULL, msg VARCHAR(1024));")
-            db.create("CREATE TABLE command (time INT UNSIGNED NOT NULL, cmd VARCHAR(1024), popped ENUM('Y','N'));")
+            print("tables and indexes are created by: python water/migrations.py migrate")
+            return
+        if sys.argv[1] == 'backfill_rollups':
+            backfill_rollups(db)
+            return
+        if sys.argv[1] == 'backfill_overflow':
+            backfill_overflow(db)
             return
         if sys.argv[1] == 'delete_height':
             if len(sys.argv) == 3 and sys.argv[2] == 'really_do':
@@ -195,11 +536,16 @@ def main():
             else:
                 print("please confirm deletion of table including all data: %s delete_height really_do" % sys.argv[0])
 
-    print(read_height(db, 30))
+    print(''.join(read_height(db, DEFAULT_DEVICE, 30)))
+
 
+if __name__ == "__main__" and not __package__:  # python water/waterbag.py
+    from jawsdb import JawsDB, stream_pre, page_params, next_page_link, device_param, PAGE_LIMIT, DEFAULT_DEVICE
+    import cache, recent
+else:  # imported by the server or python -m water.waterbag
+    from .jawsdb import JawsDB, stream_pre, page_params, next_page_link, device_param, PAGE_LIMIT, DEFAULT_DEVICE
+    from . import cache, recent, ingest  # the ingest queue is started by the server only
+    from .openweather import rain_soon_mm  # check_forecast is not used from the command line
 
 if __name__ == "__main__":
-    from jawsdb import JawsDB
     main()
-else:
-    from .jawsdb import JawsDB